@@ -1,9 +1,12 @@
 import streamlit as st
 from inputs import (initialize, 
     address_inputs, zoom_inputs, radius_inputs, 
-    set_origin, set_clippin_radius)
+    set_origin, set_clippin_radius, set_dedupe_mode)
 from pollination_streamlit_io import get_host
-from simulation import get_output
+from simulation import get_output, has_output
+from extract import PROVIDER_NAME, extract_available
+from metrics import start_metrics_server
+from pool import start_pool
 
 st.set_page_config(
     page_title='Find & Import 3D Building Context',
@@ -34,20 +37,27 @@ def main():
         'import your context geometry directly into Rhino ')
 
     # initialize the app and load up all of the inputs
+    start_metrics_server()
+    start_pool()
     initialize()
-    st.session_state.platform = get_host(key='host-platform')
+    # None until the host answers, the platform set before is kept
+    st.session_state.platform = get_host(key='host-platform') or \
+        st.session_state.platform
     # tab1, tab2 = st.tabs(('Search', 'Results'))
     
     # with tab1:
     col1, col2 = st.columns(2)
     sel_provider = col1.selectbox(
         label='Provider',
-        options=('OSM Buildings', 'OpenStreetMap'),
+        options=('OSM Buildings', 'OpenStreetMap', PROVIDER_NAME),
         key='provider',
         help='Select the source for data.')
 
     if sel_provider == 'OSM Buildings':
         q_options = QUERY_MODE[:1]
+    elif sel_provider == PROVIDER_NAME:
+        # no geocoding, it works offline
+        q_options = QUERY_MODE[2:]
     else:
         q_options = QUERY_MODE[1:]
 
@@ -56,7 +66,12 @@ def main():
         options=q_options,
         key='search-by',
         help='Parameters used by the query.')
+    if sel_provider == PROVIDER_NAME and not extract_available():
+        st.warning('No local extract found. Index one with '
+            '`python extract.py region.osm.pbf` or set CONTEXT3D_EXTRACT.')
+        return
     set_clippin_radius()
+    set_dedupe_mode()
     set_origin()
     
     if mode == QUERY_MODE[0]:
@@ -70,7 +85,7 @@ def main():
     #     st.success('Done! Go to Results tab.')
 
     # with tab2:
-    if st.session_state.data:
+    if has_output():
         get_output()
 
 if __name__ == '__main__':
@@ -1,30 +1,222 @@
 # coding=utf-8
-import uuid
+import math
+import hashlib
+from collections import defaultdict
 from honeybee.shade import Shade
 from honeybee.model import Model
+from ladybug_geometry.geometry3d.pointvector import Point3D, Vector3D
+from ladybug_geometry.geometry3d.face import Face3D
 from ladybug_display.geometry3d.polyface import DisplayPolyface3D
 from ladybug_display.geometry3d.face import DisplayFace3D
+from metrics import stage
 
-def get_model(geometry_dicts):
-    ''' From geometries to model '''
-    model = Model(identifier=str(uuid.uuid4()))
+# meters
+TOLERANCE = 0.01
+# grid of the footprint edge index
+CELL_SIZE = 10.0
+
+def _get_extrusion(polyface):
+    ''' Footprint, bottom and top elevation of a vertical extrusion.
+    None if the polyface is not an extrusion of a horizontal face.
+    '''
+    z_min, z_max = polyface.min.z, polyface.max.z
+    tops = [f for f in polyface.faces if f.normal.z > 0.999 and \
+        abs(f.center.z - z_max) < TOLERANCE]
+    bottoms = [f for f in polyface.faces if f.normal.z < -0.999 and \
+        abs(f.center.z - z_min) < TOLERANCE]
+    if len(tops) != 1 or len(bottoms) != 1:
+        return None
+
+    top = tops[0]
+    try:
+        # collinear vertices make coplanar walls
+        top = top.remove_colinear_vertices(TOLERANCE)
+    except (AssertionError, ValueError):
+        pass
+    return top, z_min, z_max
+
+def _get_segments(extrusions):
+    ''' Footprint edges as (building, p1, p2) in plan '''
+    segments = []
+    for i, (footprint, _, _) in enumerate(extrusions):
+        loops = [footprint.boundary] + list(footprint.holes or [])
+        for loop in loops:
+            for j, p1 in enumerate(loop):
+                p2 = loop[(j + 1) % len(loop)]
+                segments.append((i, (p1.x, p1.y), (p2.x, p2.y)))
+    return segments
+
+def _get_wall(p1, p2, z_min, z_max):
+    ''' Vertical face on the plan segment p1-p2 '''
+    return Face3D([Point3D(p1[0], p1[1], z_min),
+        Point3D(p2[0], p2[1], z_min),
+        Point3D(p2[0], p2[1], z_max),
+        Point3D(p1[0], p1[1], z_max)])
+
+def _get_walls(footprint, z_min, z_max):
+    ''' One wall for each edge of the footprint '''
+    return [_get_wall(p1, p2, z_min, z_max)
+        for _, p1, p2 in _get_segments([(footprint, z_min, z_max)])]
+
+def _cells(p1, p2):
+    ''' Grid cells covered by the bounding box of a segment '''
+    x0, x1 = sorted((p1[0], p2[0]))
+    y0, y1 = sorted((p1[1], p2[1]))
+    for x in range(math.floor((x0 - TOLERANCE) / CELL_SIZE),
+        math.floor((x1 + TOLERANCE) / CELL_SIZE) + 1):
+        for y in range(math.floor((y0 - TOLERANCE) / CELL_SIZE),
+            math.floor((y1 + TOLERANCE) / CELL_SIZE) + 1):
+            yield x, y
+
+def _overlap(p1, p2, q1, q2):
+    ''' Parameters of the part of p1-p2 shared with a collinear q1-q2.
+    Only anti-parallel edges count: the walls are back to back, while
+    edges in the same direction are on the same side of the line.
+    '''
+    dx, dy = p2[0] - p1[0], p2[1] - p1[1]
+    length = math.hypot(dx, dy)
+    if length < TOLERANCE:
+        return None
+    dx, dy = dx / length, dy / length
+    if dx * (q2[0] - q1[0]) + dy * (q2[1] - q1[1]) >= 0:
+        return None
+    params = []
+    for q in (q1, q2):
+        vx, vy = q[0] - p1[0], q[1] - p1[1]
+        if abs(dx * vy - dy * vx) > TOLERANCE:
+            return None
+        params.append(dx * vx + dy * vy)
+    start = max(0.0, min(params))
+    end = min(length, max(params))
+    if end - start < TOLERANCE:
+        return None
+    return start / length, end / length
+
+def _get_culled_walls(extrusions):
+    ''' Walls of the buildings without the parts hidden by a neighbour
+    on the same footprint edge. It returns the walls of each building
+    and the number of walls removed or trimmed.
+    '''
+    segments = _get_segments(extrusions)
+    grid = defaultdict(list)
+    for s, (_, p1, p2) in enumerate(segments):
+        for cell in _cells(p1, p2):
+            grid[cell].append(s)
+
+    walls = [[] for _ in extrusions]
+    culled = 0
+    for i, p1, p2 in segments:
+        _, z_min, z_max = extrusions[i]
+        candidates = set()
+        for cell in _cells(p1, p2):
+            candidates.update(grid[cell])
+
+        # neighbour walls along this edge as (start, end, top)
+        covers = []
+        for t in candidates:
+            j, q1, q2 = segments[t]
+            if j == i:
+                continue
+            _, n_min, n_max = extrusions[j]
+            if n_min > z_min + TOLERANCE:
+                continue
+            interval = _overlap(p1, p2, q1, q2)
+            if interval:
+                covers.append((*interval, min(n_max, z_max)))
+
+        if not covers:
+            walls[i].append(_get_wall(p1, p2, z_min, z_max))
+            continue
+
+        culled += 1
+        breaks = sorted({0.0, 1.0} | {c[0] for c in covers} | \
+            {c[1] for c in covers})
+        # visible bottom of each piece, equal adjacent pieces are merged
+        pieces = []
+        for a, b in zip(breaks[:-1], breaks[1:]):
+            mid = (a + b) / 2
+            low = max([c[2] for c in covers if c[0] <= mid <= c[1]],
+                default=z_min)
+            if pieces and abs(pieces[-1][2] - low) < TOLERANCE:
+                pieces[-1][1] = b
+            else:
+                pieces.append([a, b, low])
+
+        for a, b, low in pieces:
+            if z_max - low < TOLERANCE:
+                continue
+            pa = (p1[0] + (p2[0] - p1[0]) * a, p1[1] + (p2[1] - p1[1]) * a)
+            pb = (p1[0] + (p2[0] - p1[0]) * b, p1[1] + (p2[1] - p1[1]) * b)
+            walls[i].append(_get_wall(pa, pb, low, z_max))
+
+    return walls, culled
+
+def _get_identifier(face, used):
+    ''' Shade identifier derived from the vertices of its face.
+    Identical faces are numbered in order.
+    '''
+    digits = -int(math.log10(TOLERANCE))
+    text = ';'.join(f'{round(p.x, digits)},{round(p.y, digits)},'
+        f'{round(p.z, digits)}' for p in face.vertices)
+    identifier = 'shade_' + hashlib.sha1(text.encode()).hexdigest()[:16]
+    count = used[identifier]
+    used[identifier] += 1
+    return f'{identifier}_{count}' if count else identifier
+
+def _get_faces(extrusion, walls, reduce_faces):
+    ''' Roof, walls and the bottom face if not reduced '''
+    footprint, z_min, z_max = extrusion
+    faces = [footprint] + walls
+    if not reduce_faces:
+        bottom = footprint.move(Vector3D(0, 0, z_min - z_max)).flip()
+        faces.append(bottom)
+    return faces
+
+@stage('model')
+def get_model(geometry_dicts, reduce_faces=False, cull_walls=False):
+    ''' From geometries to model.
+    With reduce_faces polyfaces are converted to context shades and
+    with cull_walls the walls shared by adjacent buildings are removed.
+    It returns the model dictionary and the number of faces and shades.
+    '''
+    report = {'faces': 0}
+    faces = []
+    extrusions = []
 
     for geo_d in geometry_dicts:
         if geo_d.get('type') == 'DisplayPolyface3D':
             geo = DisplayPolyface3D.from_dict(geo_d)
-            for f in geo.geometry.faces:
-                shd = Shade(identifier=str(uuid.uuid4()),
-                    geometry=f)
-                if shd:
-                    model.add_shade(shd)
+            report['faces'] += len(geo.geometry.faces)
+            extrusion = _get_extrusion(geo.geometry) \
+                if reduce_faces or cull_walls else None
+            if extrusion:
+                extrusions.append(extrusion)
+            else:
+                faces.extend(geo.geometry.faces)
         elif geo_d.get('type') == 'DisplayFace3D':
             geo = DisplayFace3D.from_dict(geo_d)
-            shd = Shade(identifier=str(uuid.uuid4()),
-                geometry=geo.geometry)
-            if shd: 
-                model.add_shade(shd)
+            report['faces'] += 1
+            faces.append(geo.geometry)
+
+    if cull_walls:
+        walls, report['shared_walls'] = _get_culled_walls(extrusions)
+    else:
+        walls = [_get_walls(*e) for e in extrusions]
+    for extrusion, building_walls in zip(extrusions, walls):
+        faces.extend(_get_faces(extrusion, building_walls, reduce_faces))
 
+    used = defaultdict(int)
+    shades = [Shade(identifier=_get_identifier(f, used), geometry=f)
+        for f in faces]
+    # the same shades make the same model
+    digest = hashlib.sha1(''.join(s.identifier for s in shades).encode())
+    model = Model(identifier=f'context_{digest.hexdigest()[:16]}')
+    for shd in shades:
+        if shd:
+            model.add_shade(shd)
+
+    report['shades'] = len(model.shades)
     if model.shades:
-        return model.to_dict()
-    
-    return {}
\ No newline at end of file
+        return model.to_dict(), report
+
+    return {}, report
@@ -0,0 +1,110 @@
+# coding=utf-8
+''' A module to remove redundant building geometries before extrusion. '''
+from typing import Tuple
+from collections import defaultdict
+import numpy as np
+import geopandas as gpd
+from shapely import wkt
+from shapely.ops import unary_union
+from metrics import stage
+
+DEDUPE_MODES = ('Keep parts', 'Keep outlines', 'Off')
+# meters, data must be projected
+TOLERANCE = 0.05
+# share of an outline area its parts cover to replace it
+PART_COVERAGE = 0.9
+PART_KEY = 'building:part'
+
+def with_parts(tags: dict) -> dict:
+    ''' Tags to fetch, buildings come with their parts '''
+    if 'building' in tags and PART_KEY not in tags:
+        return {**tags, PART_KEY: True}
+    return tags
+
+def _duplicates(data: gpd.GeoDataFrame) -> np.ndarray:
+    ''' Mask of exact duplicates, the first one is kept '''
+    keys = data.geometry.apply(lambda g: wkt.dumps(g,
+        rounding_precision=2) if g is not None else None)
+    return keys.duplicated().values & keys.notna().values
+
+def _building_rows(data: gpd.GeoDataFrame) -> np.ndarray:
+    ''' Mask of the rows tagged building or building:part '''
+    rows = np.zeros(len(data), dtype=bool)
+    for key in ('building', PART_KEY):
+        if key in data:
+            rows |= data[key].notna().values
+    return rows
+
+def _containers(outlines: gpd.GeoSeries,
+    parts: gpd.GeoSeries) -> Tuple[set, set]:
+    ''' Positions of outlines covered by the parts they contain and of
+    contained parts
+    '''
+    outline_ids, part_ids = set(), set()
+    if outlines.empty or parts.empty:
+        return outline_ids, part_ids
+
+    index = outlines.sindex
+    contained = defaultdict(list)
+    for i, part in enumerate(parts):
+        if part is None or part.is_empty:
+            continue
+        for j in index.intersection(part.bounds):
+            if outlines.iloc[j].buffer(TOLERANCE).contains(part):
+                contained[j].append(part)
+                part_ids.add(i)
+
+    # an outline with a part on the roof is not replaced by it
+    for j, inside in contained.items():
+        area = outlines.iloc[j].area
+        if area and unary_union(inside).area >= PART_COVERAGE * area:
+            outline_ids.add(j)
+
+    return outline_ids, part_ids
+
+@stage('dedupe')
+def dedupe_buildings(data: gpd.GeoDataFrame,
+    mode: str = DEDUPE_MODES[0],
+    all_buildings: bool = False) -> Tuple[np.ndarray, dict]:
+    ''' Get a mask of the rows to keep and the numbers removed.
+
+    Unless the mode is 'Off', exact duplicates among the buildings are
+    removed, other features are kept as they are. If the data has
+    building:part features, 'Keep parts' removes the outlines covered
+    by their parts and 'Keep outlines' removes the parts inside outlines.
+    With all_buildings every row is a building, as in OSM Buildings.
+    '''
+    keep = np.ones(len(data), dtype=bool)
+    if mode == DEDUPE_MODES[-1] or data.empty:
+        return keep, {}
+
+    buildings = keep.copy() if all_buildings else _building_rows(data)
+    duplicates = np.zeros(len(data), dtype=bool)
+    if buildings.any():
+        duplicates[buildings] = _duplicates(data[buildings])
+    keep &= ~duplicates
+    report = {'duplicates': int(duplicates.sum())}
+
+    if PART_KEY not in data:
+        return keep, report
+
+    is_part = data[PART_KEY].notna().values & keep
+    is_outline = ~is_part & keep
+    if 'building' in data:
+        is_outline &= data['building'].notna().values
+    outline_pos = np.flatnonzero(is_outline)
+    part_pos = np.flatnonzero(is_part)
+
+    outline_ids, part_ids = _containers(
+        data.geometry.iloc[outline_pos].reset_index(drop=True),
+        data.geometry.iloc[part_pos].reset_index(drop=True))
+
+    if mode == DEDUPE_MODES[0]:
+        drop = outline_pos[sorted(outline_ids)]
+        report['outlines'] = len(drop)
+    else:
+        drop = part_pos[sorted(part_ids)]
+        report['parts'] = len(drop)
+    keep[drop.astype(int)] = False
+
+    return keep, report
@@ -0,0 +1,146 @@
+# coding=utf-8
+''' A module to estimate the cost of a query before anything is fetched. '''
+import os
+import math
+import threading
+from typing import List, Optional
+from query import generate_urls
+
+# per-query budgets, 0 disables a budget
+MAX_TILES = int(os.environ.get('CONTEXT3D_MAX_TILES', 64))
+MAX_FEATURES = int(os.environ.get('CONTEXT3D_MAX_FEATURES', 50000))
+MAX_PAYLOAD_BYTES = int(os.environ.get('CONTEXT3D_MAX_PAYLOAD_BYTES',
+    250000000))
+# 'downgrade' shrinks the query to fit the budgets, 'refuse' stops it
+BUDGET_POLICY = os.environ.get('CONTEXT3D_BUDGET_POLICY', 'downgrade')
+
+# features per km2 until a query has run nearby, a dense city centre
+DEFAULT_DENSITIES = {'building': 3000.0, 'buildings': 3000.0}
+DEFAULT_DENSITY = 300.0
+# GeoJSON in both frames plus the extruded geometry of a feature
+BYTES_PER_FEATURE = 4000
+# degrees, size of the cells of the density statistics
+CELL_SIZE = 0.1
+# km
+EARTH_CIRCUMFERENCE = 40075.016686
+TILE_ZOOM = 15
+MIN_RADIUS = 10
+
+# observed densities shared by all sessions, (cell, tag key) -> density
+_densities = {}
+_lock = threading.Lock()
+
+def _cell(lat: float, lon: float):
+    return math.floor(lat / CELL_SIZE), math.floor(lon / CELL_SIZE)
+
+def _circle_area(radius: float) -> float:
+    ''' Area in km2 of a circle with radius in meters '''
+    return math.pi * (radius / 1000) ** 2
+
+def _tile_area(lat: float) -> float:
+    ''' Area in km2 of an OSM Buildings tile at a latitude '''
+    side = EARTH_CIRCUMFERENCE * math.cos(math.radians(lat)) \
+        / 2 ** TILE_ZOOM
+    return side * side
+
+def get_density(lat: float, lon: float, key: str) -> float:
+    ''' Observed features per km2 of a tag key, or the default '''
+    with _lock:
+        density = _densities.get((_cell(lat, lon), key))
+    if density is None:
+        return DEFAULT_DENSITIES.get(key, DEFAULT_DENSITY)
+    return density
+
+def record_density(lat: float, lon: float, keys: List[str],
+    area: float, city_info: dict):
+    ''' Update the densities with the counts of a finished query '''
+    if area <= 0:
+        return
+    counts = dict.fromkeys(keys, 0)
+    for name, info in city_info.items():
+        key = name.split(':')[0]
+        if key in counts:
+            counts[key] += info.get('count', 0)
+
+    cell = _cell(lat, lon)
+    with _lock:
+        for key, count in counts.items():
+            density = count / area
+            old = _densities.get((cell, key))
+            _densities[(cell, key)] = density if old is None \
+                else (old + density) / 2
+
+def _estimate(lat, lon, keys, tiles, area, delivered_area):
+    density = sum(get_density(lat, lon, k) for k in keys)
+    features = int(density * area)
+    return {
+        'tiles': tiles,
+        'area': area,
+        'delivered_area': delivered_area,
+        'features': features,
+        'bytes': int(density * delivered_area * BYTES_PER_FEATURE)
+    }
+
+def estimate_by_radius(lat: float, lon: float, tags: dict,
+    radius: float, clipping_radius: Optional[int]=0) -> dict:
+    ''' Estimate of an Overpass or local extract query '''
+    area = _circle_area(radius)
+    delivered = _circle_area(min(radius, clipping_radius)) \
+        if clipping_radius else area
+    return _estimate(lat, lon, list(tags), 0, area, delivered)
+
+def estimate_by_zoom(lat: float, lon: float, zoom: int,
+    clipping_radius: Optional[int]=0) -> dict:
+    ''' Estimate of an OSM Buildings query '''
+    tiles = len(generate_urls(lat=lat, lon=lon, zoom=zoom))
+    area = tiles * _tile_area(lat)
+    delivered = min(area, _circle_area(clipping_radius)) \
+        if clipping_radius else area
+    return _estimate(lat, lon, ['buildings'], tiles, area, delivered)
+
+def over_budget(estimate: dict) -> List[str]:
+    ''' Names of the budgets exceeded by an estimate '''
+    exceeded = []
+    if MAX_TILES and estimate['tiles'] > MAX_TILES:
+        exceeded.append('tiles')
+    if MAX_FEATURES and estimate['features'] > MAX_FEATURES:
+        exceeded.append('features')
+    if MAX_PAYLOAD_BYTES and estimate['bytes'] > MAX_PAYLOAD_BYTES:
+        exceeded.append('payload')
+    return exceeded
+
+def fit_radius(lat: float, lon: float, tags: dict, radius: int,
+    clipping_radius: Optional[int]=0) -> Optional[int]:
+    ''' Largest radius up to the given one within the budgets.
+    None if even the smallest radius is over budget.
+    '''
+    while radius >= MIN_RADIUS:
+        estimate = estimate_by_radius(lat, lon, tags, radius,
+            clipping_radius)
+        if not over_budget(estimate):
+            return radius
+        # features grow with the area
+        scale = math.sqrt(0.9 * MAX_FEATURES / estimate['features']) \
+            if MAX_FEATURES and estimate['features'] else 0.9
+        radius = min(radius - 10, int(radius * scale) // 10 * 10)
+    return None
+
+def fit_zoom(lat: float, lon: float, zoom: int,
+    clipping_radius: Optional[int]=0) -> Optional[int]:
+    ''' Lowest zoom from the given one within the budgets.
+    None if a single tile is over budget.
+    '''
+    for z in range(zoom, TILE_ZOOM + 1):
+        if not over_budget(estimate_by_zoom(lat, lon, z,
+            clipping_radius)):
+            return z
+    return None
+
+def describe(estimate: dict) -> str:
+    ''' Short text of an estimate '''
+    text = f'~{estimate["features"]:,} features on ' \
+        f'{estimate["area"]:.2f} km2, ' \
+        f'~{estimate["bytes"] / 1e6:.1f} MB'
+    if estimate['tiles']:
+        text = f'{estimate["tiles"]} tiles, ' + text
+    return text
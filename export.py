@@ -0,0 +1,146 @@
+# coding=utf-8
+''' A module to export features to GIS formats.
+
+Export columns are built from the geodataframes of a query, before the
+GeoJSON encoding, and kept as one Arrow stream with a record batch per
+layer. The writers read the geometries as WKB from it.
+'''
+import os
+import tempfile
+import warnings
+from typing import List, Optional
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio.raw
+import geopandas as gpd
+from metrics import stage
+from serialize import SHAPELY2, dumps
+
+FRAMES = ('WGS84', 'Local')
+
+# a fixed schema lets every layer be written as it is read
+SCHEMA = pa.schema([
+    ('layer', pa.string()),
+    ('key', pa.string()),
+    ('value', pa.string()),
+    ('height', pa.float64()),
+    ('tags', pa.string()),
+    ('geometry', pa.binary())
+])
+# the stored columns have the geometries of both frames
+COLUMNS_SCHEMA = SCHEMA.append(pa.field('local', pa.binary()))
+FIELDS = [f.name for f in SCHEMA if f.name != 'geometry']
+
+def _wkb(geometries: gpd.GeoSeries) -> list:
+    ''' WKB of each geometry, one array call with shapely 2 '''
+    if SHAPELY2 is not None:
+        return SHAPELY2.to_wkb(geometries.values)
+    return [g.wkb for g in geometries]
+
+def _tags(props: pd.DataFrame) -> List[str]:
+    ''' JSON of the tags with a value of each row '''
+    if not len(props.columns):
+        return ['{}'] * len(props)
+    props = props.astype(object).where(pd.notna(props), None)
+    return [dumps({k: v for k, v in r.items() if v is not None})
+        for r in props.to_dict('records')]
+
+def to_columns(layer: str, data: gpd.GeoDataFrame,
+    local: gpd.GeoSeries) -> pa.RecordBatch:
+    ''' Export columns of a layer, data in WGS84 and local the same
+    geometries moved to the origin.
+    '''
+    has_geometry = ~(data.geometry.isna() | data.geometry.is_empty).values
+    data, local = data[has_geometry], local[has_geometry]
+    key, _, value = layer.partition(':')
+    props = data.drop(columns=[data.geometry.name, 'height'],
+        errors='ignore').dropna(axis=1, how='all')
+    height = pd.to_numeric(data['height'], errors='coerce') \
+        if 'height' in data else pd.Series(np.nan, index=data.index)
+
+    return pa.RecordBatch.from_arrays([
+        pa.array([layer] * len(data), pa.string()),
+        pa.array([key] * len(data), pa.string()),
+        pa.array([value] * len(data), pa.string()),
+        pa.array(height.values, pa.float64(), from_pandas=True),
+        pa.array(_tags(props), pa.string()),
+        pa.array(_wkb(data.geometry), pa.binary()),
+        pa.array(_wkb(local), pa.binary())
+    ], schema=COLUMNS_SCHEMA)
+
+def join_columns(batches: List[pa.RecordBatch]) -> Optional[bytes]:
+    ''' One Arrow stream of the layers, None without features '''
+    batches = [b for b in batches if b.num_rows]
+    if not batches:
+        return None
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, COLUMNS_SCHEMA) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+def _iter_layers(columns: Optional[bytes], local: bool):
+    ''' Yield one layer at a time in the export schema '''
+    if not columns:
+        return
+    drop = 'geometry' if local else 'local'
+    for batch in pa.ipc.open_stream(columns):
+        table = pa.Table.from_batches([batch]).drop([drop])
+        yield table.rename_columns(SCHEMA.names)
+
+def _geo_metadata(crs: Optional[str]):
+    ''' GeoParquet file metadata '''
+    column = {
+        'encoding': 'WKB',
+        'geometry_types': []
+    }
+    if crs is None:
+        # local coordinates, unknown CRS
+        column['crs'] = None
+
+    return dumps({
+        'version': '1.0.0',
+        'primary_column': 'geometry',
+        'columns': {'geometry': column}
+    })
+
+@stage('export')
+def to_geoparquet(columns: Optional[bytes], local: bool=False) -> bytes:
+    ''' Write layers to GeoParquet, one row group per layer '''
+    crs = None if local else 'OGC:CRS84'
+    schema = SCHEMA.with_metadata({'geo': _geo_metadata(crs)})
+    sink = pa.BufferOutputStream()
+    with pq.ParquetWriter(sink, schema, compression='zstd') as writer:
+        for table in _iter_layers(columns, local):
+            writer.write_table(table.replace_schema_metadata(
+                schema.metadata))
+
+    return sink.getvalue().to_pybytes()
+
+def _write_fgb(path: str, table: pa.Table, crs: Optional[str]):
+    with warnings.catch_warnings():
+        # local coordinates have no CRS on purpose
+        warnings.filterwarnings('ignore', message="'crs' was not")
+        pyogrio.raw.write(path,
+            geometry=table['geometry'].to_numpy(zero_copy_only=False),
+            field_data=[table[f].to_numpy(zero_copy_only=False)
+                for f in FIELDS],
+            fields=FIELDS,
+            driver='FlatGeobuf',
+            geometry_type='Unknown',
+            crs=crs)
+
+@stage('export')
+def to_flatgeobuf(columns: Optional[bytes], local: bool=False) -> bytes:
+    ''' Write layers to FlatGeobuf from the WKB of the columns '''
+    crs = None if local else 'EPSG:4326'
+    tables = list(_iter_layers(columns, local))
+    table = pa.concat_tables(tables) if tables \
+        else SCHEMA.empty_table()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'features.fgb')
+        _write_fgb(path, table, crs)
+        with open(path, 'rb') as f:
+            return f.read()
@@ -0,0 +1,185 @@
+# coding=utf-8
+''' A module to query a local regional extract.
+
+The extract (an OSM PBF or a GeoJSON file) is indexed once with
+
+    python extract.py region.osm.pbf --out extracts/region
+
+into a GeoParquet file sorted in spatial order and an on-disk R-tree
+of the feature bounding boxes. Queries read only the row groups
+that contain the R-tree hits.
+'''
+import os
+import re
+import math
+import argparse
+from pathlib import Path
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow.parquet as pq
+from rtree import index
+from shapely import wkb
+from metrics import upstream
+from dedupe import with_parts
+
+PROVIDER_NAME = 'Local Extract'
+EXTRACT_DIR = os.environ.get('CONTEXT3D_EXTRACT', 'extracts/default')
+FEATURES_FILE = 'features.parquet'
+INDEX_NAME = 'rtree'
+ROW_GROUP_SIZE = 8192
+# meters per degree of latitude
+DEGREE_LENGTH = 111320.0
+# hstore pairs of the GDAL OSM driver: "key"=>"value"
+OTHER_TAGS = re.compile(r'"((?:[^"\\]|\\.)*)"=>"((?:[^"\\]|\\.)*)"')
+
+# Index
+
+def _parse_other_tags(value):
+    ''' From GDAL other_tags to dictionary '''
+    if not isinstance(value, str):
+        return {}
+    return dict(OTHER_TAGS.findall(value))
+
+def _read_pbf(source: Path) -> gpd.GeoDataFrame:
+    ''' Read points, lines and areas of a PBF with the GDAL OSM driver '''
+    frames = []
+    for layer in ('points', 'lines', 'multipolygons'):
+        data = gpd.read_file(source, layer=layer)
+        if data.empty:
+            continue
+        if 'other_tags' in data:
+            tags = pd.DataFrame(data['other_tags'] \
+                .apply(_parse_other_tags).tolist(), index=data.index)
+            tags = tags[[c for c in tags.columns if c not in data]]
+            data = pd.concat([data.drop(columns='other_tags'), tags],
+                axis=1)
+        frames.append(data)
+
+    return gpd.GeoDataFrame(pd.concat(frames, ignore_index=True),
+        crs='epsg:4326')
+
+def _single_parts(geometries: gpd.GeoSeries) -> gpd.GeoSeries:
+    ''' Single-part multipolygons as polygons.
+    The GDAL OSM driver returns every area as a multipolygon, closed
+    building ways too, and only polygons are extruded.
+    '''
+    return geometries.apply(lambda g: g.geoms[0]
+        if g is not None and g.geom_type == 'MultiPolygon'
+        and len(g.geoms) == 1 else g)
+
+def _morton_key(x, y, bits=16):
+    ''' Interleave the bits of two integer grids '''
+    key = np.zeros(len(x), dtype=np.uint64)
+    for i in range(bits):
+        key |= ((x >> i) & 1).astype(np.uint64) << np.uint64(2 * i)
+        key |= ((y >> i) & 1).astype(np.uint64) << np.uint64(2 * i + 1)
+    return key
+
+def build_index(source: str, out: str = EXTRACT_DIR) -> Path:
+    ''' Index a regional extract for local queries '''
+    source, out = Path(source), Path(out)
+    if source.suffix == '.pbf':
+        data = _read_pbf(source)
+    else:
+        data = gpd.read_file(source)
+    data = data.to_crs('epsg:4326')
+    data = data[~(data.geometry.is_empty | data.geometry.isna())]
+    data = data.set_geometry(_single_parts(data.geometry))
+
+    # spatial order keeps neighbours in the same row groups
+    bounds = data.geometry.bounds
+    cx = ((bounds.minx + bounds.maxx) / 2 + 180) / 360
+    cy = ((bounds.miny + bounds.maxy) / 2 + 90) / 180
+    grid = (1 << 16) - 1
+    order = np.argsort(_morton_key((cx * grid).astype(np.int64).values,
+        (cy * grid).astype(np.int64).values), kind='stable')
+    data = data.iloc[order].reset_index(drop=True)
+
+    # tags as strings
+    for c in data.columns:
+        if c != data.geometry.name:
+            data[c] = data[c].where(data[c].isna(), data[c].astype(str))
+
+    out.mkdir(parents=True, exist_ok=True)
+    data.to_parquet(out.joinpath(FEATURES_FILE),
+        row_group_size=ROW_GROUP_SIZE)
+
+    bounds = data.geometry.bounds.values
+    stream = ((i, tuple(b), None) for i, b in enumerate(bounds))
+    idx = index.Index(str(out.joinpath(INDEX_NAME)), stream)
+    idx.close()
+
+    return out
+
+# Query
+
+def extract_available(path: str = EXTRACT_DIR) -> bool:
+    ''' Check if an indexed extract exists '''
+    path = Path(path)
+    return path.joinpath(FEATURES_FILE).exists() and \
+        path.joinpath(INDEX_NAME + '.idx').exists()
+
+@lru_cache(maxsize=4)
+def _open_extract(path: str):
+    ''' Open the index and the features file once per process '''
+    path = Path(path)
+    idx = index.Index(str(path.joinpath(INDEX_NAME)))
+    parquet = pq.ParquetFile(path.joinpath(FEATURES_FILE),
+        memory_map=True)
+    return idx, parquet
+
+def _bbox_from_point(lat, lon, dist):
+    ''' Bounding box around a point like osmnx does '''
+    dlat = dist / DEGREE_LENGTH
+    dlon = dist / (DEGREE_LENGTH * math.cos(math.radians(lat)))
+    return lon - dlon, lat - dlat, lon + dlon, lat + dlat
+
+def _filter_tags(data: pd.DataFrame, tags: dict):
+    ''' Keep rows that match any of the tags '''
+    mask = pd.Series(False, index=data.index)
+    for k, v in tags.items():
+        if k not in data:
+            continue
+        if v is True:
+            mask |= data[k].notna()
+        elif isinstance(v, str):
+            mask |= data[k] == v
+        else:
+            mask |= data[k].isin(v)
+    return data[mask]
+
+@upstream('extract')
+def get_dataframe_from_extract(lat: float,
+    lon: float,
+    tags: dict,
+    radius: int = 500,
+    path: str = EXTRACT_DIR):
+    ''' Get features around a point from the local extract '''
+    idx, parquet = _open_extract(str(path))
+    bbox = _bbox_from_point(lat, lon, radius)
+    ids = np.fromiter(idx.intersection(bbox), dtype=np.int64)
+    if not len(ids):
+        return gpd.GeoDataFrame(geometry=[], crs='epsg:4326')
+
+    # read only row groups with hits
+    ids.sort()
+    groups = np.unique(ids // ROW_GROUP_SIZE)
+    table = parquet.read_row_groups(groups.tolist())
+    local_ids = np.searchsorted(groups, ids // ROW_GROUP_SIZE) \
+        * ROW_GROUP_SIZE + ids % ROW_GROUP_SIZE
+    data = table.take(local_ids).to_pandas()
+    data = _filter_tags(data, with_parts(tags))
+    geometry = [wkb.loads(g) for g in data.pop('geometry')]
+
+    return gpd.GeoDataFrame(data, geometry=geometry, crs='epsg:4326')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Index a regional OSM extract for local queries.')
+    parser.add_argument('source', help='OSM PBF or GeoJSON file.')
+    parser.add_argument('--out', default=EXTRACT_DIR,
+        help='Output folder of the index.')
+    args = parser.parse_args()
+    print(f'Index saved to {build_index(args.source, args.out)}')
@@ -1,4 +1,9 @@
 # coding=utf-8
+import os
+import math
+import json
+import hashlib
+from collections import defaultdict
 from ladybug_geojson.convert.geojson import from_geojson
 from ladybug_geometry.geometry3d.pointvector import Point3D
 from ladybug_geometry.geometry3d.line import LineSegment3D
@@ -12,6 +17,10 @@ from ladybug_display.geometry3d.polyline import DisplayPolyline3D
 from ladybug_display.geometry3d.face import DisplayFace3D
 from ladybug_display.geometry3d.polyface import DisplayPolyface3D
 
+# meters, width of the rings around the origin that batch the
+# previews sent to CAD hosts
+RING_SIZE = float(os.environ.get('CONTEXT3D_RING_SIZE', 100))
+
 def to_dis_geometry(geometry, color):
     if isinstance(geometry, Point3D):
         return DisplayPoint3D(geometry, color)
@@ -26,6 +35,16 @@ def to_dis_geometry(geometry, color):
     else:
         return geometry
 
+def get_identifier(geo_d) -> str:
+    ''' Identifier of a display geometry derived from its content '''
+    text = json.dumps(geo_d, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+def _to_dict(dis_geo):
+    geo_d = dis_geo.to_dict()
+    geo_d['identifier'] = get_identifier(geo_d)
+    return geo_d
+
 def get_geometry(data, color):
     objs = from_geojson(data)
     col = Color(*color)
@@ -38,15 +57,65 @@ def get_geometry(data, color):
         if h and isinstance(geo, Face3D):
             geo = Polyface3D.from_offset_face(geo, h)
             dis_geo = DisplayPolyface3D(geo, col)
-            dis_geometries.append(dis_geo.to_dict())
+            dis_geometries.append(_to_dict(dis_geo))
             continue
         
         if isinstance(geo, list):
             for g in geo:
                 dis_geo = to_dis_geometry(g, col)
-                dis_geometries.append(dis_geo.to_dict())
+                dis_geometries.append(_to_dict(dis_geo))
         else:
             dis_geo = to_dis_geometry(geo, col)
-            dis_geometries.append(dis_geo.to_dict())
+            dis_geometries.append(_to_dict(dis_geo))
     
-    return dis_geometries
\ No newline at end of file
+    return dis_geometries
+
+def _get_xy(geometry_d):
+    ''' Center in plan of a geometry dictionary '''
+    if 'vertices' in geometry_d:
+        points = geometry_d['vertices']
+    elif 'boundary' in geometry_d:
+        points = geometry_d['boundary']
+    elif 'p' in geometry_d:
+        points = [geometry_d['p']]
+    else:
+        points = [(geometry_d.get('x', 0), geometry_d.get('y', 0))]
+    if not points:
+        return 0, 0
+    return sum(p[0] for p in points) / len(points), \
+        sum(p[1] for p in points) / len(points)
+
+def _batch(geos, size):
+    ids = sorted(g.get('identifier') or get_identifier(g) for g in geos)
+    key = hashlib.sha1(''.join(ids).encode()).hexdigest()[:12]
+    return key, geos, size
+
+def get_batches(dis_geometries, max_bytes, ring=RING_SIZE):
+    ''' Group display geometries in batches, nearest first.
+    Batches are rings around the origin, split by angle in parts of up
+    to max_bytes. A change at the edge of a query only changes the
+    outer rings, and the key of a batch is derived from the identifiers
+    of its geometries, so the inner batches keep their keys.
+    It returns (key, geometries, bytes) for each batch.
+    '''
+    rings = defaultdict(list)
+    for geo_d in dis_geometries:
+        x, y = _get_xy(geo_d.get('geometry', {}))
+        distance = math.hypot(x, y)
+        rings[math.floor(distance / ring)].append(
+            (math.atan2(y, x), distance, geo_d))
+
+    batches = []
+    for i in sorted(rings):
+        part, size = [], 0
+        for _, _, geo_d in sorted(rings[i], key=lambda g: g[:2]):
+            geo_size = len(json.dumps(geo_d))
+            if part and size + geo_size > max_bytes:
+                batches.append(_batch(part, size))
+                part, size = [], 0
+            part.append(geo_d)
+            size += geo_size
+        if part:
+            batches.append(_batch(part, size))
+
+    return batches
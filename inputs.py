@@ -1,7 +1,10 @@
 ''' A module for inputs. '''
+import uuid
 import streamlit as st
 from origin import Origin
 from library import read_tags
+from dedupe import DEDUPE_MODES
+from metrics import touch_session
 from simulation import (run_by_radius,
     run_by_address, run_by_zoom)
 from search_location import search_by_coordinates, search_location_by_address
@@ -10,22 +13,24 @@ GEVENT_SUPPORT=True
 
 def initialize():
     '''Initialize any of the session state variables if they don't already exist.'''
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = str(uuid.uuid4())
+    touch_session(st.session_state.session_id)
     if 'avg_lat' not in st.session_state:
         st.session_state.avg_lat = 0
     if 'avg_lon' not in st.session_state:
         st.session_state.avg_lon = 0
-    if 'lbt_objects' not in st.session_state:
-        st.session_state.lbt_objects = []
     if 'origin' not in st.session_state:
         st.session_state.origin = None
     if 'platform' not in st.session_state:
         st.session_state.platform = 'web'
-    if 'data' not in st.session_state:
-        st.session_state.data = None
-    if 'labels' not in st.session_state:
-        st.session_state.labels = None
-    if 'colors_dict' not in st.session_state:
-        st.session_state.colors_dict = {}
+    if 'result_key' not in st.session_state:
+        st.session_state.result_key = None
+    if 'cad_progress' not in st.session_state:
+        st.session_state.cad_progress = {}
+    if 'cad_sent' not in st.session_state:
+        # batch key -> object identifiers, in the CAD host now
+        st.session_state.cad_sent = {}
 
 def set_origin():
     '''Specify the lat lon of the origin of CAD 3D space'''
@@ -73,6 +78,18 @@ def set_clippin_radius():
         help=msg
     )
 
+def set_dedupe_mode():
+    '''Remove duplicated and nested buildings'''
+    msg = 'Exact duplicate buildings are removed unless it is Off.\n' + \
+        'With building:part volumes it keeps either the parts or ' + \
+        'the building outlines that contain them.'
+    st.selectbox(
+        label='Redundant buildings',
+        options=DEDUPE_MODES,
+        key='dedupe_mode',
+        help=msg
+    )
+
 def set_osm_filters(mode: str):
     '''Filter by OSM tags'''
     def get_osm_type(keyword: str):
@@ -205,7 +222,8 @@ def address_inputs():
         
         submitted = st.form_submit_button('Run')
         if submitted:
-            run_by_address(address, tags, radius)
+            run_by_address(address, tags, radius, 
+                st.session_state.provider)
             return True
 
 def zoom_inputs():
@@ -275,5 +293,6 @@ def radius_inputs():
 
         submitted = st.form_submit_button('Run')
         if submitted:
-            run_by_radius(lat, lon, tags, radius)
+            run_by_radius(lat, lon, tags, radius, 
+                st.session_state.provider)
             return True
\ No newline at end of file
@@ -11,7 +11,7 @@ def generate_element(text, color):
         display: inline-block;
         ">
     </span><span style="margin: 0px 10px 5px 5px;">{1}</span><br>
-    '''.format(tuple(color.tolist()), text).replace('\n', '')
+    '''.format(tuple(color), text).replace('\n', '')
 
 def generate_legend(legend_data: dict):
     html_leg = ''
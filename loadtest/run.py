@@ -0,0 +1,183 @@
+# coding=utf-8
+''' Load test of concurrent sessions of one app instance.
+
+It starts the upstream stand-in, points the app at it and drives N
+concurrent scripted sessions through the address, zoom and coordinate
+flows with Streamlit's AppTest. For each concurrency level it reports
+latency percentiles of the query reruns, throughput and peak RSS.
+
+    python loadtest/run.py --concurrency 1 2 4 8 --sessions 4 --latency 0.2
+'''
+import os
+import sys
+import json
+import time
+import random
+import resource
+import argparse
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = Path(__file__).parent.parent
+FLOWS = ('address', 'zoom', 'coordinates')
+
+def _set_environment(port: int):
+    base = f'http://127.0.0.1:{port}'
+    os.environ['CONTEXT3D_OSM_BUILDINGS_URL'] = f'{base}/tiles'
+    os.environ['CONTEXT3D_NOMINATIM_URL'] = f'{base}/nominatim'
+    os.environ['CONTEXT3D_OVERPASS_URL'] = f'{base}/overpass'
+    os.environ['CONTEXT3D_METRICS_PORT'] = '0'
+
+def _start_stand_in(port: int, latency: float, recordings: str):
+    process = subprocess.Popen([sys.executable,
+        str(ROOT.joinpath('loadtest', 'stand_in.py')),
+        '--port', str(port), '--latency', str(latency),
+        '--recordings', recordings])
+    time.sleep(2)
+    return process
+
+def _keep_runtime():
+    ''' AppTest sets the global Runtime at each run and clears it at the
+    end, under the runs of the other sessions. The last one is kept.
+    '''
+    from streamlit.runtime import Runtime
+    last = []
+
+    def instance(cls):
+        if cls._instance is not None:
+            last[:] = [cls._instance]
+        if not last:
+            raise RuntimeError('Runtime hasn\'t been created!')
+        return last[0]
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(
+        lambda cls: cls._instance is not None or bool(last))
+
+def _find(elements, key):
+    return next(e for e in elements if e.key == key)
+
+def _submit(at):
+    ''' Click Run and time the rerun '''
+    button = next(b for b in at.button if b.label == 'Run')
+    start = time.perf_counter()
+    button.click().run()
+    elapsed = time.perf_counter() - start
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+    return elapsed
+
+def run_session(flow: str, jitter: float, timeout: float):
+    ''' One scripted session, it returns the query latency '''
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(str(ROOT.joinpath('app.py')),
+        default_timeout=timeout)
+    # there is no host under AppTest, the sessions are web sessions
+    at.session_state['platform'] = 'web'
+    at.run()
+    if flow == 'zoom':
+        _find(at.selectbox, 'provider').select('OSM Buildings').run()
+        _find(at.selectbox, 'zoom').select(15)
+    elif flow == 'address':
+        _find(at.selectbox, 'provider').select('OpenStreetMap').run()
+        _find(at.selectbox, 'search-by') \
+            .select('By Address & Radius').run()
+        # the address is fixed, the radius skips the shared caches
+        _find(at.slider, 'by_address_radius') \
+            .set_value(300 + 10 * round(jitter * 1000))
+    else:
+        _find(at.selectbox, 'provider').select('OpenStreetMap').run()
+        _find(at.selectbox, 'search-by') \
+            .select('By Coordinates & Radius').run()
+        _find(at.number_input, 'lat').set_value(40.7495292 + jitter)
+        _find(at.number_input, 'lon').set_value(-73.9928448 + jitter)
+        _find(at.slider, 'by_radius_radius').set_value(300)
+
+    return _submit(at)
+
+def _percentile(values, p):
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+def run_level(concurrency: int, sessions: int, unique: bool,
+    timeout: float):
+    ''' Run concurrency x sessions scripted sessions '''
+    jobs = []
+    for i in range(concurrency * sessions):
+        # new coordinates skip the shared caches
+        jitter = random.uniform(-0.01, 0.01) if unique else 0.0
+        jobs.append((FLOWS[i % len(FLOWS)], jitter))
+
+    latencies, errors = [], 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(run_session, flow, jitter, timeout)
+            for flow, jitter in jobs]
+        for f in futures:
+            try:
+                latencies.append(f.result())
+            except Exception as e:
+                errors += 1
+                print(f'Session failed: {e}')
+    elapsed = time.perf_counter() - start
+
+    # kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {
+        'concurrency': concurrency,
+        'sessions': len(jobs),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed,
+        'p50': _percentile(latencies, 50) if latencies else None,
+        'p95': _percentile(latencies, 95) if latencies else None,
+        'p99': _percentile(latencies, 99) if latencies else None,
+        'peak_rss_mb': peak_rss
+    }
+
+def _print_row(r):
+    fmt = lambda v: f'{v:8.2f}' if v is not None else '       -'
+    print(f'{r["concurrency"]:11d} {r["sessions"]:8d} {r["errors"]:6d} '
+        f'{fmt(r["throughput"])} {fmt(r["p50"])} {fmt(r["p95"])} '
+        f'{fmt(r["p99"])} {fmt(r["peak_rss_mb"])}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load test of concurrent app sessions.')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+        default=[1, 2, 4, 8])
+    parser.add_argument('--sessions', type=int, default=3,
+        help='Sessions run by each concurrent user.')
+    parser.add_argument('--latency', type=float, default=0.2,
+        help='Seconds of latency of the stand-in services.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--recordings', default='loadtest/recordings')
+    parser.add_argument('--unique', action='store_true',
+        help='Jitter the coordinates of each session.')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--json', help='Save the results to a file.')
+    args = parser.parse_args()
+
+    _set_environment(args.port)
+    _keep_runtime()
+    sys.path.insert(0, str(ROOT))
+    os.chdir(ROOT)
+    stand_in = _start_stand_in(args.port, args.latency, args.recordings)
+    results = []
+    try:
+        print('concurrency sessions errors  sess/s      p50      p95'
+            '      p99  rss(MB)')
+        for level in args.concurrency:
+            result = run_level(level, args.sessions, args.unique,
+                args.timeout)
+            results.append(result)
+            _print_row(result)
+    finally:
+        stand_in.terminate()
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
@@ -0,0 +1,205 @@
+# coding=utf-8
+''' Local stand-in for OSM Buildings, Overpass and Nominatim.
+
+It replays recorded responses from a folder and generates a regular
+grid of buildings for the requests that were not recorded. With
+--record the missing responses are fetched from the real services
+and saved for later runs. Every response waits --latency seconds.
+
+    python loadtest/stand_in.py --port 8765 --latency 0.2
+
+Point the app at it with
+
+    CONTEXT3D_OSM_BUILDINGS_URL=http://127.0.0.1:8765/tiles
+    CONTEXT3D_NOMINATIM_URL=http://127.0.0.1:8765/nominatim
+    CONTEXT3D_OVERPASS_URL=http://127.0.0.1:8765/overpass
+'''
+import re
+import json
+import math
+import random
+import asyncio
+import hashlib
+import argparse
+from pathlib import Path
+import aiohttp
+from aiohttp import web
+
+UPSTREAMS = {
+    'tiles': 'https://data.osmbuildings.org/0.2/anonymous/tile',
+    'nominatim': 'https://nominatim.openstreetmap.org',
+    'overpass': 'https://overpass-api.de/api'
+}
+# Times Square
+DEFAULT_LOCATION = (40.7579747, -73.9855426)
+# degrees between synthetic buildings, about 30 m
+SPACING = 0.0003
+# half size of a synthetic building in degrees
+HALF_SIZE = 0.0001
+POLY = re.compile(r'poly:"([-\d. ]+)"')
+BBOX = re.compile(r'\(\s*([-\d.]+)\s*,\s*([-\d.]+)\s*,'
+    r'\s*([-\d.]+)\s*,\s*([-\d.]+)\s*\)')
+
+# Synthetic data
+
+def _grid(south, west, north, east):
+    ''' Grid cells of the synthetic buildings in a bounding box '''
+    for i in range(math.floor(south / SPACING),
+        math.ceil(north / SPACING)):
+        for j in range(math.floor(west / SPACING),
+            math.ceil(east / SPACING)):
+            yield i, j
+
+def _building(i, j):
+    ''' Footprint ring and height of the building of a grid cell '''
+    rnd = random.Random(i * 1000003 + j)
+    lat, lon = i * SPACING, j * SPACING
+    dlat = HALF_SIZE * rnd.uniform(0.6, 1.4)
+    dlon = HALF_SIZE * rnd.uniform(0.6, 1.4)
+    ring = [(lon - dlon, lat - dlat), (lon + dlon, lat - dlat),
+        (lon + dlon, lat + dlat), (lon - dlon, lat + dlat)]
+    return ring, round(rnd.uniform(6, 120), 1)
+
+def _tile_bounds(z, x, y):
+    n = 2 ** z
+    west = x / n * 360 - 180
+    east = (x + 1) / n * 360 - 180
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return south, west, north, east
+
+def synthetic_tile(z, x, y):
+    features = []
+    for i, j in _grid(*_tile_bounds(z, x, y)):
+        ring, height = _building(i, j)
+        features.append({
+            'type': 'Feature',
+            'id': f'{i}_{j}',
+            'properties': {'height': height},
+            'geometry': {'type': 'Polygon',
+                'coordinates': [ring + [ring[0]]]}
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+def _query_bounds(query):
+    ''' Bounding box of an Overpass query '''
+    match = POLY.search(query)
+    if match:
+        values = [float(v) for v in match.group(1).split()]
+        lats, lons = values[0::2], values[1::2]
+        return min(lats), min(lons), max(lats), max(lons)
+    match = BBOX.search(query)
+    if match:
+        return tuple(float(v) for v in match.groups())
+    lat, lon = DEFAULT_LOCATION
+    return lat - 0.005, lon - 0.005, lat + 0.005, lon + 0.005
+
+def synthetic_overpass(query):
+    elements = []
+    # with out geom the ways carry their geometry
+    with_nodes = 'out geom' not in query
+    for i, j in _grid(*_query_bounds(query)):
+        ring, height = _building(i, j)
+        way_id = abs(i) * 1000003 + abs(j)
+        node_ids = []
+        for k, (lon, lat) in enumerate(ring):
+            node_ids.append(way_id * 10 + k)
+            if with_nodes:
+                elements.append({'type': 'node', 'id': node_ids[-1],
+                    'lat': lat, 'lon': lon})
+        tags = {'building': 'yes', 'height': str(height)}
+        if (i + j) % 7 == 0:
+            tags['amenity'] = 'school'
+        elements.append({'type': 'way', 'id': way_id,
+            'nodes': node_ids + node_ids[:1], 'tags': tags,
+            'geometry': [{'lat': lat, 'lon': lon}
+                for lon, lat in ring + ring[:1]]})
+    return {'version': 0.6, 'elements': elements}
+
+def synthetic_nominatim(q):
+    lat, lon = DEFAULT_LOCATION
+    return [{
+        'place_id': 1, 'lat': str(lat), 'lon': str(lon),
+        'display_name': q or 'Times Square',
+        'boundingbox': [str(lat - 0.001), str(lat + 0.001),
+            str(lon - 0.001), str(lon + 0.001)]
+    }]
+
+# Server
+
+def make_app(recordings: Path, latency: float, record: bool):
+    recordings.mkdir(parents=True, exist_ok=True)
+
+    async def replay(service, key_text, fetch, generate):
+        ''' Recorded, fetched or generated response '''
+        await asyncio.sleep(latency)
+        key = hashlib.sha1(key_text.encode()).hexdigest()
+        path = recordings.joinpath(service, f'{key}.json')
+        if path.exists():
+            return web.Response(body=path.read_bytes(),
+                content_type='application/json')
+        if record:
+            data = await fetch()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps(data))
+        else:
+            data = generate()
+        return web.json_response(data)
+
+    async def tiles(request):
+        z, x, y = (int(request.match_info[k]) for k in ('z', 'x', 'y'))
+        url = f'{UPSTREAMS["tiles"]}/{z}/{x}/{y}.json'
+        return await replay('tiles', url,
+            lambda: _fetch('GET', url),
+            lambda: synthetic_tile(z, x, y))
+
+    async def nominatim(request):
+        params = dict(request.query)
+        url = f'{UPSTREAMS["nominatim"]}/search'
+        key = url + json.dumps(params, sort_keys=True)
+        return await replay('nominatim', key,
+            lambda: _fetch('GET', url, params=params),
+            lambda: synthetic_nominatim(params.get('q', '')))
+
+    async def overpass_status(request):
+        return web.Response(text='Connected as: 0\nCurrent time: 0\n'
+            'Rate limit: 0\n2 slots available now.\n')
+
+    async def overpass(request):
+        if request.method == 'POST':
+            form = await request.post()
+            query = form.get('data', '')
+        else:
+            query = request.query.get('data', '')
+        url = f'{UPSTREAMS["overpass"]}/interpreter'
+        return await replay('overpass', url + query,
+            lambda: _fetch('POST', url, data={'data': query}),
+            lambda: synthetic_overpass(query))
+
+    app = web.Application()
+    app.router.add_get('/tiles/{z}/{x}/{y}.json', tiles)
+    app.router.add_get('/nominatim/search', nominatim)
+    app.router.add_get('/overpass/status', overpass_status)
+    app.router.add_route('*', '/overpass/interpreter', overpass)
+    return app
+
+async def _fetch(method, url, **kwargs):
+    async with aiohttp.ClientSession(
+        headers={'User-Agent': 'context-3d-loadtest'}) as session:
+        async with session.request(method, url, **kwargs) as resp:
+            return await resp.json(content_type=None)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the upstream services.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.2,
+        help='Seconds to wait before each response.')
+    parser.add_argument('--recordings', default='loadtest/recordings',
+        help='Folder of recorded responses.')
+    parser.add_argument('--record', action='store_true',
+        help='Fetch and save the responses that are not recorded.')
+    args = parser.parse_args()
+    web.run_app(make_app(Path(args.recordings), args.latency, args.record),
+        host=args.host, port=args.port)
@@ -0,0 +1,121 @@
+# coding=utf-8
+''' A module for process-wide operational metrics.
+
+Metrics are served in Prometheus text format on a side port
+(CONTEXT3D_METRICS_PORT, 0 to disable) bound to CONTEXT3D_METRICS_ADDR,
+loopback by default, for a local scraper.
+'''
+import os
+import time
+import threading
+from functools import wraps
+from prometheus_client import (CollectorRegistry, Counter,
+    Gauge, Histogram, start_http_server)
+
+METRICS_PORT = int(os.environ.get('CONTEXT3D_METRICS_PORT', 9464))
+METRICS_ADDR = os.environ.get('CONTEXT3D_METRICS_ADDR', '127.0.0.1')
+# seconds without reruns before a session is idle
+SESSION_TIMEOUT = 300
+
+REGISTRY = CollectorRegistry()
+
+UPSTREAM_REQUESTS = Counter('context3d_upstream_requests',
+    'Requests to upstream services.',
+    ['upstream', 'status'], registry=REGISTRY)
+UPSTREAM_SECONDS = Histogram('context3d_upstream_seconds',
+    'Latency of upstream requests.',
+    ['upstream'], registry=REGISTRY,
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+STAGE_SECONDS = Histogram('context3d_stage_seconds',
+    'Duration of pipeline stages.',
+    ['stage'], registry=REGISTRY,
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+CACHE_LOOKUPS = Counter('context3d_cache_lookups',
+    'Lookups of cached pipeline stages.',
+    ['cache'], registry=REGISTRY)
+CACHE_MISSES = Counter('context3d_cache_misses',
+    'Lookups of cached pipeline stages that ran the stage.',
+    ['cache'], registry=REGISTRY)
+QUERY_FEATURES = Histogram('context3d_query_features',
+    'Features returned by a query.',
+    registry=REGISTRY,
+    buckets=(10, 100, 500, 1000, 5000, 10000, 50000, 100000))
+QUERY_VERTICES = Histogram('context3d_query_vertices',
+    'Vertices of the geometries of a query.',
+    registry=REGISTRY,
+    buckets=(1e3, 1e4, 5e4, 1e5, 5e5, 1e6, 5e6))
+PAYLOAD_BYTES = Histogram('context3d_payload_bytes',
+    'Size of downloads and CAD payloads.',
+    ['payload'], registry=REGISTRY,
+    buckets=(1e4, 1e5, 1e6, 1e7, 5e7, 1e8, 5e8))
+ACTIVE_SESSIONS = Gauge('context3d_active_sessions',
+    'Sessions with a rerun in the last minutes.',
+    registry=REGISTRY)
+RESULT_STORE_BYTES = Gauge('context3d_result_store_bytes',
+    'Compressed size of the shared query results.',
+    registry=REGISTRY)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_server_lock = threading.Lock()
+_server_started = False
+
+def _count_sessions():
+    now = time.monotonic()
+    with _sessions_lock:
+        for k in [k for k, t in _sessions.items()
+            if now - t > SESSION_TIMEOUT]:
+            del _sessions[k]
+        return len(_sessions)
+
+ACTIVE_SESSIONS.set_function(_count_sessions)
+
+def touch_session(session_id: str):
+    ''' Mark a session as active '''
+    with _sessions_lock:
+        _sessions[session_id] = time.monotonic()
+
+def start_metrics_server():
+    ''' Serve the metrics once per process '''
+    global _server_started
+    if not METRICS_PORT:
+        return
+    with _server_lock:
+        if _server_started:
+            return
+        try:
+            start_http_server(METRICS_PORT, addr=METRICS_ADDR,
+                registry=REGISTRY)
+        except OSError as e:
+            print(f'Metrics server not started: {e}')
+        _server_started = True
+
+def observe_upstream(upstream: str, seconds: float, ok: bool = True):
+    UPSTREAM_SECONDS.labels(upstream).observe(seconds)
+    UPSTREAM_REQUESTS.labels(upstream, 'ok' if ok else 'error').inc()
+
+def upstream(name: str):
+    ''' Decorator to time and count requests to an upstream '''
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                res = fn(*args, **kwargs)
+            except Exception:
+                observe_upstream(name, time.perf_counter() - start, False)
+                raise
+            observe_upstream(name, time.perf_counter() - start)
+            return res
+        return wrapper
+    return decorator
+
+def stage(name: str):
+    ''' Decorator to time a pipeline stage '''
+    return STAGE_SECONDS.labels(name).time()
+
+def cache_lookup(cache: str):
+    CACHE_LOOKUPS.labels(cache).inc()
+
+def cache_miss(cache: str):
+    CACHE_MISSES.labels(cache).inc()
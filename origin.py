@@ -1,7 +1,7 @@
 # coding=utf-8
 class Origin:
 
-    __slot__ = (
+    __slots__ = (
       'lat', 'lon'
     )
 
@@ -10,4 +10,8 @@ class Origin:
         lon:float):
 
         self.lat = lat
-        self.lon = lon
\ No newline at end of file
+        self.lon = lon
+
+    def __reduce__(self):
+        # st.cache hashes arguments by their reduced form
+        return (Origin, (self.lat, self.lon))
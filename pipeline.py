@@ -0,0 +1,54 @@
+# coding=utf-8
+''' CPU-bound stages of a query, run in the app or in a pool worker. '''
+import hashlib
+from typing import List
+from geometry_parser import get_geometry
+from query import (find_features, osm_find_buildings,
+    parallel_map, MAX_WORKERS)
+from metrics import stage
+
+def layer_color(key: str) -> List[int]:
+    '''Color of a layer, the same for every session'''
+    digest = hashlib.sha1(key.encode()).digest()
+    return list(digest[:3])
+
+@stage('extrude')
+def extrude(utm_dict):
+    '''Extrude each group, in worker processes if enabled'''
+    colors = [layer_color(k) for k in utm_dict]
+    if MAX_WORKERS and len(utm_dict) > 1:
+        geometries = parallel_map(get_geometry,
+            utm_dict.values(), colors)
+    else:
+        geometries = map(get_geometry, utm_dict.values(), colors)
+
+    objects = []
+    for geos in geometries:
+        objects.extend(geos)
+
+    return objects
+
+def elaborate_data(dataset, tags, origin,
+    clipping_radius, init_origin, dedupe_mode):
+    '''Elaborate the OSM request'''
+    city_info, gdf_dict, utm_dict, \
+        avg_lat, avg_lon, columns = find_features(dataset,
+        tags, origin, clipping_radius, init_origin,
+        dedupe_mode)
+
+    return gdf_dict, utm_dict, city_info, avg_lat, avg_lon, \
+        extrude(utm_dict), columns
+
+def elaborate_buildings(dataset, init_origin, origin,
+    clipping_radius, dedupe_mode):
+    '''Elaborate the OSM Buildings tiles'''
+    city_info, gdf_dict, utm_dict, \
+        avg_lat, avg_lon, columns = osm_find_buildings(
+        data=dataset,
+        init_origin=init_origin,
+        origin=origin,
+        clipping_radius=clipping_radius,
+        dedupe_mode=dedupe_mode)
+
+    return gdf_dict, utm_dict, city_info, avg_lat, avg_lon, \
+        extrude(utm_dict), columns
@@ -0,0 +1,137 @@
+# coding=utf-8
+''' A module to run CPU-bound stages in a persistent process pool.
+
+Streamlit runs every session on a thread of one process, so heavy
+stages share one GIL. With CONTEXT3D_POOL_WORKERS set, they run in
+worker processes started once and warmed up with the geo libraries.
+Each session has its own queue and the queues are served in turn, so
+one large query does not hold the workers for everybody else.
+'''
+import os
+import threading
+import multiprocessing
+from functools import partial, lru_cache
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+POOL_WORKERS = int(os.environ.get('CONTEXT3D_POOL_WORKERS', 0))
+
+def _warm_up():
+    ''' Worker initializer, it imports the geo stack once '''
+    # workers run their stages sequentially, no nested pools
+    os.environ['CONTEXT3D_WORKERS'] = '0'
+    os.environ['CONTEXT3D_POOL_WORKERS'] = '0'
+    import pipeline
+    import convert
+
+def _ready():
+    return os.getpid()
+
+class FairQueue:
+    ''' Round robin of per-session queues over a process pool.
+    At most one task per worker is handed to the pool, the rest wait
+    in their session queue.
+    '''
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        # reentrant: a task that is already done runs its callback
+        # in the dispatching thread
+        self._lock = threading.RLock()
+        self._queues = OrderedDict()
+        self._running = 0
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn: forking the threaded streamlit server is not safe
+            context = multiprocessing.get_context('spawn')
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=context,
+                initializer=_warm_up)
+        return self._executor
+
+    def start(self):
+        ''' Start and warm up all workers '''
+        with self._lock:
+            executor = self._get_executor()
+        for _ in range(self.workers):
+            executor.submit(_ready)
+
+    def submit(self, session: str, fn, *args, **kwargs) -> Future:
+        future = Future()
+        with self._lock:
+            self._queues.setdefault(session, deque()) \
+                .append((future, fn, args, kwargs))
+            self._dispatch()
+        return future
+
+    def _dispatch(self):
+        ''' Hand tasks to free workers, one session at a time '''
+        while self._running < self.workers and self._queues:
+            session, queue = self._queues.popitem(last=False)
+            future, fn, args, kwargs = queue.popleft()
+            # the session waits behind the others for its next task
+            if queue:
+                self._queues[session] = queue
+            if not future.set_running_or_notify_cancel():
+                continue
+            self._running += 1
+            try:
+                task = self._submit(fn, args, kwargs)
+            except Exception as e:
+                self._running -= 1
+                future.set_exception(e)
+                continue
+            task.add_done_callback(partial(self._done, future))
+
+    def _submit(self, fn, args, kwargs) -> Future:
+        try:
+            return self._get_executor().submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            self._executor = None
+            return self._get_executor().submit(fn, *args, **kwargs)
+
+    def _done(self, future: Future, task: Future):
+        error = task.exception()
+        with self._lock:
+            self._running -= 1
+            if isinstance(error, BrokenProcessPool):
+                # a worker died, the next task starts a new pool
+                self._executor = None
+            self._dispatch()
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(task.result())
+
+_start_lock = threading.Lock()
+_started = False
+
+@lru_cache(maxsize=None)
+def _get_queue():
+    ''' The queue of the process, None if the pool is disabled.
+    It is not a module global: the legacy st.cache hashes the globals
+    reached from a cached function and the queue holds locks.
+    '''
+    return FairQueue(POOL_WORKERS) if POOL_WORKERS else None
+
+def start_pool():
+    ''' Start the workers once per process, if enabled '''
+    global _started
+    with _start_lock:
+        queue = _get_queue()
+        if queue is not None and not _started:
+            queue.start()
+            _started = True
+
+def dispatch(session: str, fn, *args, **kwargs):
+    ''' Run a function in the pool and wait for its result.
+    It runs in the calling thread if the pool is disabled.
+    '''
+    queue = _get_queue()
+    if queue is None:
+        return fn(*args, **kwargs)
+    return queue.submit(session, fn, *args, **kwargs).result()
@@ -4,20 +4,63 @@ import osmnx as ox
 import pandas as pd
 from geopy.geocoders import Nominatim
 import geopandas as gpd
+import re
 import asyncio
 import aiohttp
 import ssl
 from origin import Origin
+from dedupe import DEDUPE_MODES, PART_KEY, dedupe_buildings, with_parts
+from singleflight import single_flight
+from metrics import upstream, stage, observe_upstream
+from serialize import to_geojson, WGS84_DIGITS, LOCAL_DIGITS
+from export import to_columns, join_columns
 from shapely.geometry.point import Point
+from shapely.geometry import LineString, Polygon, MultiPolygon
+from shapely.ops import linemerge, polygonize, unary_union
 from ladybug_geojson.slippy.map import ( 
     tile_from_lat_lon,
     get_recurrent_tiles )
 import json
+import os
+import math
+from urllib.parse import urlparse
+import time
+import threading
+import multiprocessing
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from shapely import wkb
 # docs
 # https://geopandas.org/en/stable/docs/reference.html
 # https://osmnx.readthedocs.io/en/stable/index.html
 
 DEFAULT_HEIGHT = 3.0
+# upstream services, they can point to local stand-ins
+OSM_BUILDINGS_URL = os.environ.get('CONTEXT3D_OSM_BUILDINGS_URL',
+    'https://data.osmbuildings.org/0.2/anonymous/tile')
+NOMINATIM_URL = os.environ.get('CONTEXT3D_NOMINATIM_URL',
+    'https://nominatim.openstreetmap.org')
+OVERPASS_URL = os.environ.get('CONTEXT3D_OVERPASS_URL',
+    'https://overpass-api.de/api')
+# worker processes used for tag groups and extrusion, 0 to disable
+MAX_WORKERS = int(os.environ.get('CONTEXT3D_WORKERS', 0))
+# side in meters of the boxes of an Overpass query, requests at once
+OVERPASS_BOX_SIZE = int(os.environ.get('CONTEXT3D_OVERPASS_BOX', 1000))
+# overpass-api.de gives 2 query slots to each IP
+OVERPASS_CONCURRENCY = int(os.environ.get(
+    'CONTEXT3D_OVERPASS_CONCURRENCY', 2))
+OVERPASS_TIMEOUT = 180
+OVERPASS_RETRIES = 5
+# seconds, longest wait for a free slot before a retry
+OVERPASS_MAX_WAIT = 60
+EARTH_RADIUS = 6371009
+# layer of a feature with several selected tag keys, the first one
+# wins. Keys that are not listed follow in the order of the query
+LAYER_PRECEDENCE = tuple(k for k in os.environ.get(
+    'CONTEXT3D_LAYER_PRECEDENCE',
+    'building,amenity,leisure,landuse,natural').split(',') if k)
 
 # OSM Buildings
 
@@ -27,8 +70,15 @@ async def get(
     **kwargs
 ) -> dict:
     print(f"Requesting {url}")
-    resp = await session.request('GET', url=url, **kwargs)
-    data = await resp.json()
+    start = time.perf_counter()
+    ok = False
+    try:
+        resp = await session.request('GET', url=url, **kwargs)
+        data = await resp.json()
+        ok = resp.status == 200
+    finally:
+        observe_upstream('osm_buildings', 
+            time.perf_counter() - start, ok)
     print(f"Received data for {url}")
     return data
 
@@ -40,8 +90,16 @@ async def main(urls, **kwargs):
         htmls = await asyncio.gather(*tasks, return_exceptions=True)
         return htmls
 
+def get_locator(user_agent: str):
+    ''' Geocoder of the configured Nominatim service '''
+    url = urlparse(NOMINATIM_URL)
+    return Nominatim(user_agent=user_agent, scheme=url.scheme,
+        domain=url.netloc + url.path.rstrip('/'))
+
+@single_flight
+@upstream('nominatim')
 def from_address_to_lat_lon(address):
-    locator = Nominatim(user_agent='loc-finder')
+    locator = get_locator(user_agent='loc-finder')
     location = locator.geocode(address)
 
     return location
@@ -57,27 +115,16 @@ def generate_urls(lat: float,
 
     if tiles:
         urls = [
-        f'https://data.osmbuildings.org/0.2/anonymous/tile/15/{x}/{y}.json' \
+        f'{OSM_BUILDINGS_URL}/15/{x}/{y}.json' \
         for x, y in tiles]
 
     return urls
 
-def osm_find_buildings(address: str, 
-        zoom: int,
-        origin: Origin,
-        clipping_radius: Optional[int]=0):
-    
-    city_info = {}
-    json_dict = {}
-    utm_json_dict = {}
-
-    location = from_address_to_lat_lon(address)
-
-    if not location:
-        return city_info, json_dict, \
-            utm_json_dict, None, None
-
-    lat, lon = location.latitude, location.longitude
+@single_flight
+def get_dataframe_from_tiles(lat: float,
+        lon: float,
+        zoom: int):
+    ''' Download OSM Buildings tiles around a point '''
     urls = generate_urls(lat=lat, 
         lon=lon, zoom=zoom)
     htmls = asyncio.run(main(urls))
@@ -86,25 +133,55 @@ def osm_find_buildings(address: str,
 
     df_list = []
     for feat in htmls:
+        if isinstance(feat, Exception):
+            continue
         data = gpd.GeoDataFrame.from_features(feat)
         if data.size != 0:
             data.crs = 'epsg:4326'
             df_list.append(data)
 
+    if not df_list:
+        return gpd.GeoDataFrame(), Origin(lat=lat, lon=lon)
+
     df = gpd.GeoDataFrame(pd.concat(df_list, ignore_index=True))
-    
-    if df.empty:
+
+    return df, Origin(lat=lat, lon=lon)
+
+@stage('osm_find_buildings')
+def osm_find_buildings(data: gpd.GeoDataFrame, 
+        init_origin: Origin,
+        origin: Optional[Origin]=None,
+        clipping_radius: Optional[int]=0,
+        dedupe_mode: Optional[str]=DEDUPE_MODES[0]):
+    ''' Get buildings from OSM Buildings tiles '''
+    city_info = {}
+    json_dict = {}
+    utm_json_dict = {}
+
+    if data is None:
         return city_info, json_dict, \
-            utm_json_dict, lat, lon
+            utm_json_dict, None, None, None
 
-    cp = df.copy()
+    lat, lon = init_origin.lat, init_origin.lon
+
+    if data.empty:
+        return city_info, json_dict, \
+            utm_json_dict, lat, lon, None
+
+    cp = data.copy()
     cp.crs = 'epsg:4326'
     utm_group = ox.project_gdf(cp)
 
+    # overlapping footprints of adjacent tiles
+    keep, dedupe_report = dedupe_buildings(utm_group, dedupe_mode,
+        all_buildings=True)
+    cp, utm_group = cp[keep], utm_group[keep]
+    if dedupe_report:
+        city_info['dedupe'] = dedupe_report
+
     # calculate centroid from init location
     avg_lat, avg_lon = lat, lon
-    avg_utm_lat, avg_utm_lon = _from_origin_to_utm(Origin(lat=lat, 
-        lon=lon))
+    avg_utm_lat, avg_utm_lon = _from_origin_to_utm(init_origin)
 
     # clipping mask
     if clipping_radius:
@@ -121,7 +198,8 @@ def osm_find_buildings(address: str,
         avg_lat, avg_lon = origin.lat, origin.lon
 
     # save to json dictionary
-    json_dict['buildings'] = cp.to_json()
+    json_dict['buildings'] = to_geojson(cp, WGS84_DIGITS)
+    city_info['buildings'] = {'count': len(cp)}
 
     d = None
     if 'height' in cp:
@@ -134,9 +212,11 @@ def osm_find_buildings(address: str,
     # from geoseries to geodataframe
     envgdf = gpd.GeoDataFrame(geometry=translated,
         data=d)
-    utm_json_dict['buildings'] = envgdf.to_json()
+    utm_json_dict['buildings'] = to_geojson(envgdf, LOCAL_DIGITS)
+    columns = join_columns([to_columns('buildings', cp, translated)])
 
-    return city_info, json_dict, utm_json_dict, avg_lat, avg_lon
+    return city_info, json_dict, utm_json_dict, avg_lat, avg_lon, \
+        columns
 
 def _from_origin_to_utm(origin):
     pt = Point(origin.lon, origin.lat)
@@ -163,7 +243,7 @@ def set_height(group,
                         regex=True, inplace=True)
 
         # try fill NaN with building:levels (building only)
-        if column:
+        if column and column in group:
             group['height'] = group['height'] \
                         .fillna(group[column].apply(try_parse)\
                         .apply(lambda x: x * DEFAULT_HEIGHT))
@@ -172,46 +252,280 @@ def set_height(group,
         group['height'] = group['height'] \
                         .fillna(DEFAULT_HEIGHT).apply(try_parse)
 
-def _get_building_settings(group):
-    settings = {}
-    cp = group.copy()
-    materials = {}
-    if 'building:material' in cp:
-        t = cp.groupby(['building:material'])['geometry'].count()
-        materials = t.to_dict()
-    if materials:
-        settings['building:material'] = materials
-
-    return settings
+def _layer_keys(tags, data):
+    ''' Tag keys of the query found in the data, in precedence order '''
+    rank = {k: i for i, k in enumerate(LAYER_PRECEDENCE)}
+    keys = [k for k in tags if k in data]
+    # stable, unlisted keys keep the order of the query
+    return sorted(keys, key=lambda k: rank.get(k, len(rank)))
+
+def _classify(data, keys):
+    ''' Primary tag key and value of each feature in one pass.
+    The other selected tags of a feature are joined as 'key:value'.
+    '''
+    present = [data[k].notna().values for k in keys]
+    values = [data[k].values for k in keys]
+    layer_key = np.select(present, np.array(keys, dtype=object), 
+        default=None)
+    layer_value = np.select(present, values, default=None)
+
+    secondary = np.full(len(data), None, dtype=object)
+    for k, mask, vals in zip(keys, present, values):
+        extra = mask & (layer_key != k)
+        if not extra.any():
+            continue
+        secondary[extra] = [f'{k}:{v}' if old is None \
+            else f'{old};{k}:{v}' 
+            for old, v in zip(secondary[extra], vals[extra])]
+
+    return layer_key, layer_value, secondary
+
+def _layer_statistics(data, layer_key, layer_value):
+    ''' Count of each layer and building materials in one aggregation '''
+    frame = pd.DataFrame({'key': layer_key, 'value': layer_value,
+        'material': data['building:material'].values \
+            if 'building:material' in data else None})
+    sizes = frame.groupby(['key', 'value', 'material'],
+        dropna=False, sort=False).size()
 
-def get_dataframe_from_lat_lon(lat: float,
+    city_info = {}
+    for (k, v, material), n in sizes.items():
+        if pd.isna(k):
+            continue
+        info = city_info.setdefault(':'.join([k, str(v)]), {'count': 0})
+        info['count'] += int(n)
+        if k == 'building' and not pd.isna(material):
+            info.setdefault('building:material', {})[material] = int(n)
+
+    return city_info
+
+def _overpass_filters(tags: dict):
+    ''' Overpass tag filters, like osmnx: True for any value '''
+    filters = []
+    for key, value in tags.items():
+        if isinstance(value, bool):
+            filters.append(f'["{key}"]')
+        elif isinstance(value, str):
+            filters.append(f'["{key}"="{value}"]')
+        else:
+            filters.extend(f'["{key}"="{v}"]' for v in value)
+    return filters
+
+def _overpass_query(tags: dict, box):
+    ''' Query of the elements with the tags in a (s, w, n, e) box '''
+    bbox = ','.join(f'{v:.7f}' for v in box)
+    statements = ''.join(f'nwr{f}({bbox});' 
+        for f in _overpass_filters(tags))
+    return f'[out:json][timeout:{OVERPASS_TIMEOUT}];' + \
+        f'({statements});out geom;'
+
+def _split_box(lat: float, lon: float, radius: float):
+    ''' Boxes of OVERPASS_BOX_SIZE covering the square around a point '''
+    d_lat = math.degrees(radius / EARTH_RADIUS)
+    d_lon = d_lat / math.cos(math.radians(lat))
+    n = max(1, math.ceil(2 * radius / OVERPASS_BOX_SIZE))
+    south, west = lat - d_lat, lon - d_lon
+    step_lat, step_lon = 2 * d_lat / n, 2 * d_lon / n
+    return [(south + i * step_lat, west + j * step_lon,
+        south + (i + 1) * step_lat, west + (j + 1) * step_lon)
+        for i in range(n) for j in range(n)]
+
+async def _overpass_wait(session: aiohttp.ClientSession,
+    retry_after: Optional[str], attempt: int) -> float:
+    ''' Seconds to wait for a free Overpass slot. From Retry-After if
+    the server sent it, else from the slot times of /status, else an
+    exponential backoff.
+    '''
+    if retry_after and retry_after.strip().isdigit():
+        return min(float(retry_after), OVERPASS_MAX_WAIT)
+    try:
+        async with session.get(f'{OVERPASS_URL}/status') as resp:
+            resp.raise_for_status()
+            text = await resp.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        text = ''
+    if 'available now' in text:
+        return 0.5
+    waits = [int(s) for s in re.findall(r'in (\d+) seconds', text)]
+    if waits:
+        return min(min(waits) + 0.5, OVERPASS_MAX_WAIT)
+    return min(2 ** attempt, OVERPASS_MAX_WAIT)
+
+async def _post_overpass(session: aiohttp.ClientSession,
+    semaphore: asyncio.Semaphore, query: str) -> list:
+    ''' Elements of a query, retried when Overpass is busy '''
+    url = f'{OVERPASS_URL}/interpreter'
+    for attempt in range(OVERPASS_RETRIES):
+        async with semaphore:
+            start = time.perf_counter()
+            ok = False
+            retry_after = None
+            try:
+                async with session.post(url, 
+                    data={'data': query}) as resp:
+                    busy = resp.status in (429, 504)
+                    if busy:
+                        retry_after = resp.headers.get('Retry-After')
+                    else:
+                        resp.raise_for_status()
+                        data = await resp.json(content_type=None)
+                        ok = True
+            finally:
+                observe_upstream('overpass',
+                    time.perf_counter() - start, ok)
+        if not busy:
+            return data.get('elements', [])
+        # wait outside the semaphore
+        await asyncio.sleep(await _overpass_wait(session,
+            retry_after, attempt))
+    raise RuntimeError(f'Overpass is busy: {url}')
+
+async def _fetch_overpass(tags: dict, boxes: list) -> list:
+    semaphore = asyncio.Semaphore(OVERPASS_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(total=OVERPASS_TIMEOUT + 30)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        tasks = [_post_overpass(session, semaphore,
+            _overpass_query(tags, box)) for box in boxes]
+        return await asyncio.gather(*tasks)
+
+# closed ways are polygons for these keys, but only for the listed
+# values of the keys in POLYGON_ONLY and not for those in LINE_VALUES
+POLYGON_KEYS = {'building', 'building:part', 'amenity', 'landuse',
+    'leisure', 'natural', 'shop', 'tourism', 'office', 'craft',
+    'historic', 'military', 'place', 'public_transport', 'sport',
+    'emergency', 'boundary', 'man_made', 'aeroway', 'aerialway', 
+    'power', 'barrier', 'highway', 'railway', 'waterway', 'area'}
+POLYGON_ONLY = {
+    'barrier': {'city_wall', 'ditch', 'hedge', 'retaining_wall', 
+        'spikes'},
+    'highway': {'services', 'rest_area', 'escape', 'elevator'},
+    'power': {'plant', 'substation', 'generator', 'transformer'},
+    'railway': {'station', 'turntable', 'roundhouse', 'platform'},
+    'waterway': {'riverbank', 'dock', 'boatyard', 'dam'}
+}
+LINE_VALUES = {
+    'natural': {'coastline', 'cliff', 'ridge', 'arete', 'tree_row'},
+    'man_made': {'cutline', 'embankment', 'pipeline'},
+    'aerialway': {'cable_car', 'gondola', 'chair_lift', 'drag_lift',
+        't-bar', 'j-bar', 'platter', 'rope_tow', 'magic_carpet', 
+        'zip_line', 'goods', 'mixed_lift'}
+}
+
+def _is_polygon(tags: dict) -> bool:
+    ''' If a closed way is an area, after the osmnx rules '''
+    if tags.get('area') == 'no':
+        return False
+    for key, value in tags.items():
+        if key not in POLYGON_KEYS:
+            continue
+        if key in POLYGON_ONLY:
+            if value in POLYGON_ONLY[key]:
+                return True
+        elif value not in LINE_VALUES.get(key, ()):
+            return True
+    return False
+
+def _way_geometry(element: dict):
+    coords = [(p['lon'], p['lat']) 
+        for p in (element.get('geometry') or []) if p]
+    if len(coords) < 2:
+        return None
+    if len(coords) >= 4 and coords[0] == coords[-1] and \
+        _is_polygon(element.get('tags', {})):
+        return Polygon(coords)
+    return LineString(coords)
+
+def _rings(members: list, role: str):
+    lines = []
+    for m in members:
+        if m.get('role') != role or m.get('type') != 'way':
+            continue
+        coords = [(p['lon'], p['lat']) 
+            for p in (m.get('geometry') or []) if p]
+        if len(coords) > 1:
+            lines.append(LineString(coords))
+    return list(polygonize(linemerge(lines))) if lines else []
+
+def _relation_geometry(element: dict):
+    ''' Multipolygon of the outer minus the inner member ways '''
+    members = element.get('members', [])
+    outer = _rings(members, 'outer')
+    if not outer:
+        return None
+    geometry = unary_union(outer)
+    inner = _rings(members, 'inner')
+    if inner:
+        geometry = geometry.difference(unary_union(inner))
+    if geometry.geom_type == 'Polygon':
+        geometry = MultiPolygon([geometry])
+    return geometry
+
+def _elements_to_gdf(elements: list) -> gpd.GeoDataFrame:
+    ''' GeoDataFrame of Overpass elements in the osmnx layout,
+    indexed by element type and OSM id.
+    '''
+    features = []
+    for e in elements:
+        tags = e.get('tags', {})
+        # untagged nodes are vertices of ways, not features
+        if not tags:
+            continue
+        if e['type'] == 'node':
+            geometry = Point(e['lon'], e['lat'])
+        elif e['type'] == 'way':
+            geometry = _way_geometry(e)
+            tags = {**tags, 'nodes': e.get('nodes')}
+        elif tags.get('type') == 'multipolygon':
+            geometry = _relation_geometry(e)
+            tags = {**tags, 'ways': [m['ref'] for m in 
+                e.get('members', []) if m.get('type') == 'way']}
+        else:
+            geometry = None
+        if geometry is None or geometry.is_empty:
+            continue
+        features.append({'element_type': e['type'], 'osmid': e['id'],
+            **tags, 'geometry': geometry})
+
+    if not features:
+        return gpd.GeoDataFrame(geometry=[], crs='epsg:4326')
+    return gpd.GeoDataFrame(features, crs='epsg:4326') \
+        .set_index(['element_type', 'osmid'])
+
+def get_overpass_dataframe(lat: float,
     lon: float,
     tags: dict,
     radius: int = 500):
-    ox.settings.log_console=True
-    ox.settings.use_cache=True
+    ''' Features with the tags around a point, fetched from Overpass
+    in boxes at once and merged by OSM id.
+    '''
+    boxes = _split_box(lat, lon, radius)
+    results = asyncio.run(_fetch_overpass(with_parts(tags), boxes))
 
-    data = ox.geometries.geometries_from_point(
-        [lat, lon],
-        tags=tags,
-        dist=radius)
-    data.crs = 'epsg:4326'
+    # elements on the edges of the boxes come more than once
+    elements = {}
+    for box_elements in results:
+        for e in box_elements:
+            elements.setdefault((e['type'], e['id']), e)
 
-    return data
+    return _elements_to_gdf(list(elements.values()))
 
-def get_dataframe_from_address(address: str,
+@single_flight
+def get_dataframe_from_lat_lon(lat: float,
+    lon: float,
     tags: dict,
     radius: int = 500):
-    ox.settings.log_console=True
-    ox.settings.use_cache=True
+    return get_overpass_dataframe(lat, lon, tags, radius)
 
-    data = ox.geometries.geometries_from_address(
-        address=address,
-        tags=tags,
-        dist=radius)
-    data.crs = 'epsg:4326'
+@single_flight
+def get_dataframe_from_address(address: str,
+    tags: dict,
+    radius: int = 500):
+    location = from_address_to_lat_lon(address)
+    if not location:
+        return gpd.GeoDataFrame(geometry=[], crs='epsg:4326')
 
-    return data
+    return get_overpass_dataframe(location.latitude, 
+        location.longitude, tags, radius)
 
 def get_dataframe_centroid(data:gpd.GeoDataFrame):
     ''' Get avg lat lon from geodaframe '''
@@ -223,11 +537,13 @@ def get_dataframe_centroid(data:gpd.GeoDataFrame):
     else:
         return None, None
 
+@stage('find_features')
 def find_features(data: gpd.GeoDataFrame,
     tags: dict,
     origin: Optional[Origin]=None,
     clipping_radius: Optional[int]=0,
-    init_origin: Optional[Origin]=None):
+    init_origin: Optional[Origin]=None,
+    dedupe_mode: Optional[str]=DEDUPE_MODES[0]):
     ''' Get features from OSM request '''
     city_info = {}
     json_dict = {}
@@ -235,14 +551,20 @@ def find_features(data: gpd.GeoDataFrame,
 
     ox.config(log_console=True, use_cache=True)
 
-    if data.empty:
+    if data is None or data.empty:
         return city_info, json_dict, \
-            utm_json_dict, None, None
+            utm_json_dict, None, None, None
 
     # global avg lat lon (utm)
     cp = data.copy()
     utm_group = ox.project_gdf(cp)
 
+    # duplicated buildings and building:part volumes
+    keep, dedupe_report = dedupe_buildings(utm_group, dedupe_mode)
+    cp, utm_group = cp[keep], utm_group[keep]
+    if dedupe_report:
+        city_info['dedupe'] = dedupe_report
+
     # calculate centroid from init location
     avg_lat, avg_lon = init_origin.lat, init_origin.lon
     avg_utm_lat, avg_utm_lon = _from_origin_to_utm(init_origin)
@@ -259,51 +581,131 @@ def find_features(data: gpd.GeoDataFrame,
         avg_utm_lat, avg_utm_lon = _from_origin_to_utm(origin)
         avg_lat, avg_lon = origin.lat, origin.lon
 
-    # TODO: fix amenities behavior
-    # TODO: improve filters
-    for k, v in tags.items():
-        try:
-            grouped = cp.groupby(k)
-        except KeyError as e:
-            grouped = None
-        if grouped:
-            # group=values
-            for key, group in grouped:
-                unique_key = ':'.join([k, key])
-
-                base_statistic={
-                    'count': len(group)
-                }
-
-                if k == 'amenity':
-                    set_height(group)
-                if k == 'building':
-                    set_height(group, 'building:levels')
-                    # merge additional building info
-                    base_statistic = {**base_statistic,
-                        **_get_building_settings(group)}
-
-                # copy height series if building
-                d = None
-                if k == 'building':
-                    if 'height' in group:
-                        d = group['height']
-
-                # save to json dictionary
-                json_dict[unique_key] = group.to_json()
-
-                # project
-                utm_group = ox.project_gdf(group)
-
-                # move to origin
-                # new geoseries with geometries
-                translated = utm_group.translate(-avg_utm_lon, -avg_utm_lat)
-
-                # from geoseries to geodataframe
-                envgdf = gpd.GeoDataFrame(geometry=translated,
-                    data=d)
-                utm_json_dict[unique_key] = envgdf.to_json()
-
-                city_info[unique_key] = base_statistic
-
-    return city_info, json_dict, utm_json_dict, avg_lat, avg_lon
+    # one layer for each feature, the other tags are kept as attribute
+    keys = _layer_keys(with_parts(tags), cp)
+    if not keys:
+        return city_info, json_dict, \
+            utm_json_dict, avg_lat, avg_lon, None
+    layer_key, layer_value, secondary = _classify(cp, keys)
+    if len(keys) > 1:
+        cp = cp.assign(secondary=secondary)
+    layer_info = _layer_statistics(cp, layer_key, layer_value)
+
+    grouped = cp.groupby([layer_key, layer_value], sort=False)
+    groups = sorted(((k, key, group) for (k, key), group in grouped),
+        key=lambda g: (keys.index(g[0]), str(g[1])))
+
+    if MAX_WORKERS and len(groups) > 1:
+        results = parallel_map(_process_packed_group,
+            [k for k, _, _ in groups],
+            [key for _, key, _ in groups],
+            [_pack_group(group) for _, _, group in groups],
+            [avg_utm_lat] * len(groups),
+            [avg_utm_lon] * len(groups))
+    else:
+        results = [_process_group(k, key, group, 
+            avg_utm_lat, avg_utm_lon) for k, key, group in groups]
+
+    # results keep the order of the groups
+    batches = []
+    for unique_key, json_data, utm_json_data, batch in results:
+        json_dict[unique_key] = json_data
+        utm_json_dict[unique_key] = utm_json_data
+        city_info[unique_key] = layer_info[unique_key]
+        batches.append(batch)
+
+    return city_info, json_dict, utm_json_dict, avg_lat, avg_lon, \
+        join_columns(batches)
+
+def _process_group(k, key, group, 
+    avg_utm_lat, avg_utm_lon):
+    ''' Set heights, project and move a group to origin.
+    It returns the GeoJSON of both frames and the export columns.
+    '''
+    unique_key = ':'.join([k, str(key)])
+
+    if k == 'amenity':
+        set_height(group)
+    if k in ('building', PART_KEY):
+        set_height(group, 'building:levels')
+
+    # copy height series if building
+    d = None
+    if k in ('building', PART_KEY):
+        if 'height' in group:
+            d = group['height']
+
+    # save to json dictionary
+    json_data = to_geojson(group, WGS84_DIGITS)
+
+    # project
+    utm_group = ox.project_gdf(group)
+
+    # move to origin
+    # new geoseries with geometries
+    translated = utm_group.translate(-avg_utm_lon, -avg_utm_lat)
+
+    # from geoseries to geodataframe
+    envgdf = gpd.GeoDataFrame(geometry=translated,
+        data=d)
+    utm_json_data = to_geojson(envgdf, LOCAL_DIGITS)
+
+    return unique_key, json_data, utm_json_data, \
+        to_columns(unique_key, group, translated)
+
+# Parallel processing
+
+def _pack_group(group):
+    ''' Compact form of a group to send to a worker process.
+    It is pickled like any argument: geometries go as one WKB buffer
+    with offsets and only the columns with values are kept.
+    '''
+    blobs = [g.wkb for g in group.geometry]
+    offsets = np.cumsum([0] + [len(b) for b in blobs])
+    columns = list(group.columns)
+    props = group.drop(columns=group.geometry.name) \
+        .dropna(axis=1, how='all')
+
+    return b''.join(blobs), offsets, props, columns, group.crs
+
+def _unpack_group(packed):
+    ''' From the compact form back to a geodataframe '''
+    buffer, offsets, props, columns, crs = packed
+    geometries = [wkb.loads(buffer[s:e]) \
+        for s, e in zip(offsets[:-1], offsets[1:])]
+    group = gpd.GeoDataFrame(props, geometry=geometries, crs=crs)
+
+    return group.reindex(columns=columns)
+
+def _process_packed_group(k, key, packed, 
+    avg_utm_lat, avg_utm_lon):
+    return _process_group(k, key, _unpack_group(packed), 
+        avg_utm_lat, avg_utm_lon)
+
+_executor_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def _get_executor():
+    ''' Process pool started on first use and kept for the process.
+    Workers import the geo libraries once. It is not a module global
+    so the legacy st.cache does not hash it.
+    '''
+    # spawn: forking the threaded streamlit server is not safe
+    context = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(max_workers=MAX_WORKERS, 
+        mp_context=context)
+
+def parallel_map(fn, *iterables):
+    ''' Map a function over a process pool keeping the input order '''
+    iterables = [list(i) for i in iterables]
+    with _executor_lock:
+        executor = _get_executor()
+    try:
+        return list(executor.map(fn, *iterables))
+    except BrokenProcessPool:
+        # a worker died, start a new pool and try once more
+        with _executor_lock:
+            if _get_executor() is executor:
+                _get_executor.cache_clear()
+            executor = _get_executor()
+        return list(executor.map(fn, *iterables))
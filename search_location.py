@@ -1,9 +1,9 @@
 import folium
-from geopy.geocoders import Nominatim
+from query import get_locator
 from streamlit_folium import st_folium
 
 def search_location_by_address(address: str, zoom:int=12):
-    location = Nominatim(user_agent="GetLoc")
+    location = get_locator(user_agent="GetLoc")
     getLocation = location.geocode(address)
     if getLocation == None:
         return
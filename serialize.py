@@ -0,0 +1,138 @@
+# coding=utf-8
+''' A module to write GeoJSON with quantized coordinates.
+
+Coordinates are written from the coordinate arrays of the geometries,
+rounded to the precision that is meaningful in each CRS, with orjson
+if it is installed.
+'''
+import os
+import gzip
+import json
+import numpy as np
+import pandas as pd
+import shapely
+import geopandas as gpd
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# decimals of WGS84 degrees, 7 is about 1 cm
+WGS84_DIGITS = int(os.environ.get('CONTEXT3D_WGS84_DIGITS', 7))
+# decimals of projected meters, 3 is 1 mm
+LOCAL_DIGITS = int(os.environ.get('CONTEXT3D_LOCAL_DIGITS', 3))
+GZIP_LEVEL = 6
+GEOJSON_TYPES = {n.upper(): n for n in ('Point', 'LineString', 'Polygon',
+    'MultiPoint', 'MultiLineString', 'MultiPolygon')}
+# shapely 2 for its array functions, None with shapely 1.8: the legacy
+# st.cache reads each attribute in the code it hashes, called or not
+SHAPELY2 = shapely if hasattr(shapely, 'to_ragged_array') else None
+
+def _array(coords, digits):
+    return np.round(np.asarray(coords, dtype=float), digits)
+
+def _coordinates(geom, digits):
+    ''' GeoJSON coordinates of a geometry as rounded arrays '''
+    kind = geom.geom_type
+    if kind == 'Point':
+        return _array(geom.coords, digits)[0]
+    if kind in ('LineString', 'LinearRing'):
+        return _array(geom.coords, digits)
+    if kind == 'Polygon':
+        return [_array(geom.exterior.coords, digits)] + \
+            [_array(r.coords, digits) for r in geom.interiors]
+    return [_coordinates(g, digits) for g in geom.geoms]
+
+def _geometry(geom, digits):
+    ''' GeoJSON geometry, None for missing or empty ones '''
+    if geom is None or geom.is_empty:
+        return None
+    if geom.geom_type == 'GeometryCollection':
+        return {
+            'type': 'GeometryCollection',
+            'geometries': [_geometry(g, digits) for g in geom.geoms]
+        }
+    return {
+        'type': geom.geom_type,
+        'coordinates': _coordinates(geom, digits)
+    }
+
+def _nest(coords, offsets, level, i):
+    ''' Coordinates of part i of a ragged array level '''
+    start, end = offsets[level][i], offsets[level][i + 1]
+    if level == 0:
+        return coords[start:end]
+    return [_nest(coords, offsets, level - 1, j)
+        for j in range(start, end)]
+
+def _ragged_geometries(geoms, digits):
+    ''' GeoJSON geometries of one coordinate array for each type.
+    Only with shapely 2, other versions go one geometry at a time.
+    '''
+    if SHAPELY2 is None:
+        return [_geometry(g, digits) for g in geoms]
+
+    geoms = np.asarray(geoms, dtype=object)
+    empty = SHAPELY2.is_missing(geoms) | SHAPELY2.is_empty(geoms)
+    types = SHAPELY2.get_type_id(geoms)
+    types[empty] = -1
+    res = [None] * len(geoms)
+    for type_id in np.unique(types):
+        ids = np.flatnonzero(types == type_id)
+        if type_id == -1:
+            continue
+        if SHAPELY2.GeometryType(type_id).name not in GEOJSON_TYPES:
+            for i in ids:
+                res[i] = _geometry(geoms[i], digits)
+            continue
+        kind, coords, offsets = SHAPELY2.to_ragged_array(geoms[ids])
+        coords = np.round(coords, digits)
+        name = GEOJSON_TYPES[kind.name]
+        for n, i in enumerate(ids):
+            res[i] = {
+                'type': name,
+                'coordinates': _nest(coords, offsets,
+                    len(offsets) - 1, n) if offsets else coords[n]
+            }
+    return res
+
+def _default(obj):
+    ''' JSON values of NumPy and other objects '''
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+def dumps(obj) -> str:
+    ''' JSON text of an object with NumPy values '''
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default,
+            option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(obj, default=_default, separators=(',', ':'))
+
+def to_geojson(data: gpd.GeoDataFrame, digits: int) -> str:
+    ''' FeatureCollection of a geodataframe, like to_json with
+    coordinates rounded to digits.
+    '''
+    props = data.drop(columns=data.geometry.name).astype(object)
+    props = props.where(pd.notna(props), None)
+    # without columns to_dict has no records at all
+    records = props.to_dict('records') if len(props.columns) \
+        else [{} for _ in range(len(props))]
+    features = [{
+        'id': str(idx),
+        'type': 'Feature',
+        'properties': p,
+        'geometry': geometry
+    } for idx, p, geometry in zip(data.index, records, 
+        _ragged_geometries(data.geometry.values, digits))]
+
+    return dumps({'type': 'FeatureCollection', 'features': features})
+
+def compress(data) -> bytes:
+    ''' Gzip a download '''
+    if isinstance(data, str):
+        data = data.encode()
+    return gzip.compress(data, GZIP_LEVEL)
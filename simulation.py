@@ -1,38 +1,52 @@
 # coding=utf-8
 from typing import List
-import numpy as np
+import os
 import json
+import hashlib
 import pydeck as pdk
 import streamlit as st
-from geometry_parser import get_geometry
-from query import ( find_features,
-    get_dataframe_from_lat_lon, 
-    get_dataframe_from_address,
-    osm_find_buildings, 
+from geometry_parser import get_batches, get_identifier
+from query import ( get_dataframe_from_lat_lon, 
+    get_dataframe_from_tiles,
     from_address_to_lat_lon)
+from pipeline import (layer_color, elaborate_data, 
+    elaborate_buildings)
+from pool import dispatch
 from ladybug.location import Location
 from pollination_streamlit_io import send_geometry, send_hbjson, manage_settings
 from legend import generate_legend
 from origin import Origin
 from convert import get_model
-import json
+from dedupe import DEDUPE_MODES
+from singleflight import single_flight
+from metrics import (cache_lookup, cache_miss, 
+    QUERY_FEATURES, QUERY_VERTICES, PAYLOAD_BYTES)
+from extract import PROVIDER_NAME, get_dataframe_from_extract
+from export import FRAMES, to_geoparquet, to_flatgeobuf
+from store import RESULTS, RESULT_TTL
+from serialize import compress
+from estimate import (BUDGET_POLICY, estimate_by_radius, 
+    estimate_by_zoom, fit_radius, fit_zoom, over_budget, 
+    record_density, describe)
 
 GEVENT_SUPPORT=True
 
-def _generate_legend_color_set(key: str) -> List[int]:
-    '''Save colors to use with legend'''
-    if key in st.session_state.colors_dict:
-        color = st.session_state.colors_dict[key].tolist()
-    else:
-        np_color = np.random.choice(range(256), size=3)
-        st.session_state.colors_dict[key] = np_color
-        color = np_color.tolist()
-    
-    return color
+# bytes of new geometry sent to a CAD host at each run of
+# progressive loading
+CHUNK_BYTES = int(os.environ.get('CONTEXT3D_CHUNK_BYTES', 2000000))
+
+EXPORTERS = {
+    'GeoParquet': (to_geoparquet, 'parquet'),
+    'FlatGeobuf': (to_flatgeobuf, 'fgb')
+}
+
+# uncompressed results kept by the query caches, the shared store
+# keeps the compressed ones
+QUERY_CACHE_ENTRIES = 8
 
 def generate_osm_layers(key, values):
     ''' Create pydeck layers from pandas data '''
-    color = _generate_legend_color_set(key)
+    color = layer_color(key)
 
     return pdk.Layer(
         'GeoJsonLayer',
@@ -50,181 +64,411 @@ def generate_osm_layers(key, values):
         pickable=True
     )
 
-def _elaborate_data(dataset, tags, origin, 
-    clipping_radius, init_origin):
-    '''Elaborate the OSM request'''
-    city_info, gdf_dict, utm_dict, \
-        avg_lat, avg_lon = find_features(dataset,
-        tags, origin, clipping_radius, init_origin)
+def _dispatch(fn, *args, **kwargs):
+    '''Run a CPU-bound stage in the worker pool, in session turns'''
+    return dispatch(st.session_state.get('session_id'), 
+        fn, *args, **kwargs)
 
-    objects = []
-    for k, v in utm_dict.items():
-        color = _generate_legend_color_set(k)
-        objects.extend(get_geometry(v, color))
+def _reset_output():
+    st.session_state.result_key = None
 
-    return gdf_dict, city_info, avg_lat, avg_lon, objects
+def _result_hash(*dicts):
+    '''Content hash of the GeoJSON of a result'''
+    h = hashlib.sha1()
+    for d in dicts:
+        for k in sorted(d):
+            h.update(k.encode())
+            h.update(d[k].encode())
+    return h.hexdigest()
 
-def _reset_output():
-    st.session_state.lbt_objects = []
-    st.session_state.data = None
-    st.session_state.labels = None
+def _observe_result(city_info, objects):
+    '''Features and vertices of a query'''
+    QUERY_FEATURES.observe(sum(v.get('count', 0) 
+        for v in city_info.values()))
+    vertices = 0
+    for geo_d in objects:
+        geometry = geo_d.get('geometry', {})
+        vertices += len(geometry.get('vertices') or \
+            geometry.get('boundary') or [0])
+    QUERY_VERTICES.observe(vertices)
+
+def _save_output(gdf_dict, utm_dict, city_info, objects, columns):
+    _observe_result(city_info, objects)
+    st.session_state.result_key = RESULTS.put(
+        _result_hash(gdf_dict, utm_dict), {
+        'data': gdf_dict,
+        'local_data': utm_dict,
+        'labels': city_info,
+        'lbt_objects': objects,
+        'columns': columns})
+
+def get_result():
+    '''Result of the session from the shared store.
+    None if there is no result or it was evicted.
+    '''
+    result = RESULTS.get(st.session_state.result_key)
+    if result is None:
+        st.session_state.result_key = None
+    return result
+
+def has_output():
+    result = get_result()
+    return bool(result and result['data'])
+
+def _memo(name, fn):
+    '''Build an output artifact once per result.
+    Sessions and reruns of the same result reuse it.
+    '''
+    return RESULTS.artifact(st.session_state.result_key, name, fn)
+
+@st.cache(suppress_st_warning=True,
+    max_entries=QUERY_CACHE_ENTRIES, ttl=RESULT_TTL)
+def geocode(address:str):
+    '''Location of an address, None if it is not found'''
+    location = from_address_to_lat_lon(address=address)
+    if not location:
+        return None
+    return Origin(lat=location.latitude, lon=location.longitude)
+
+# fetch stage: network only, keyed by location, radius and tags
+
+@st.cache(suppress_st_warning=True, allow_output_mutation=True,
+    max_entries=QUERY_CACHE_ENTRIES, ttl=RESULT_TTL)
+def fetch_by_radius(lat:float,
+    lon:float,
+    tags:List[str],
+    radius:float,
+    provider:str='OpenStreetMap'):
+    cache_miss('fetch')
+    if provider == PROVIDER_NAME:
+        dataset = get_dataframe_from_extract(
+            lat=lat, 
+            lon=lon, 
+            tags=tags,
+            radius=radius
+        )
+    else:
+        dataset = get_dataframe_from_lat_lon(
+            lat=lat, 
+            lon=lon, 
+            tags=tags,
+            radius=radius
+        )
+    return dataset, Origin(lat=lat, lon=lon)
+
+@st.cache(suppress_st_warning=True, allow_output_mutation=True,
+    max_entries=QUERY_CACHE_ENTRIES, ttl=RESULT_TTL)
+def fetch_by_address(address:str,
+    tags:List[str],
+    radius:float,
+    provider:str='OpenStreetMap'):
+    cache_miss('fetch')
+    location = geocode(address)
+    if not location:
+        return None, None
 
-@st.cache(suppress_st_warning=True)
+    if provider == PROVIDER_NAME:
+        dataset = get_dataframe_from_extract(
+            lat=location.lat, 
+            lon=location.lon, 
+            tags=tags,
+            radius=radius
+        )
+    else:
+        # the location is found once, Overpass is queried around it
+        dataset = get_dataframe_from_lat_lon(
+            lat=location.lat, 
+            lon=location.lon, 
+            tags=tags,
+            radius=radius
+        )
+    return dataset, location
+
+@st.cache(suppress_st_warning=True, allow_output_mutation=True,
+    max_entries=QUERY_CACHE_ENTRIES, ttl=RESULT_TTL)
+def fetch_by_zoom(address:str,
+    zoom:int):
+    cache_miss('fetch')
+    location = geocode(address)
+    if not location:
+        return None, None
+
+    return get_dataframe_from_tiles(
+        lat=location.lat, 
+        lon=location.lon, 
+        zoom=zoom)
+
+# post-process stage: clip, translate, extrude. Keyed by the fetch 
+# arguments plus clipping and origin, it reuses the fetched dataset
+
+@st.cache(suppress_st_warning=True,
+    max_entries=QUERY_CACHE_ENTRIES, ttl=RESULT_TTL)
+@single_flight
 def run_query_by_radius(origin:Origin,
     clipping_radius:int,
     lat:float,
     lon:float,
     tags:List[str],
-    radius:float):
-    _reset_output()
-
-    dataset = get_dataframe_from_lat_lon(
+    radius:float,
+    provider:str='OpenStreetMap',
+    dedupe_mode:str=DEDUPE_MODES[0]):
+    cache_miss('query')
+    cache_lookup('fetch')
+    dataset, init_origin = fetch_by_radius(
         lat=lat, 
         lon=lon, 
         tags=tags,
-        radius=radius
-    )
-    init_origin = Origin(lat=lat, lon=lon)
+        radius=radius,
+        provider=provider)
 
-    gdf_dict, city_info, \
-        avg_lat, avg_lon, objects = _elaborate_data(dataset=dataset,
+    gdf_dict, utm_dict, city_info, \
+        avg_lat, avg_lon, objects, columns = _dispatch(elaborate_data, 
+        dataset=dataset,
         tags=tags,
         origin=origin,
         clipping_radius=clipping_radius,
-        init_origin=init_origin)
-    return gdf_dict, city_info, avg_lat, avg_lon, objects
+        init_origin=init_origin,
+        dedupe_mode=dedupe_mode)
+    return gdf_dict, utm_dict, city_info, avg_lat, avg_lon, objects, \
+        columns
 
-@st.cache(suppress_st_warning=True)
+@st.cache(suppress_st_warning=True,
+    max_entries=QUERY_CACHE_ENTRIES, ttl=RESULT_TTL)
+@single_flight
 def run_query_by_address(
     origin:Origin,
     clipping_radius:int,
     address:str,
     tags:List[str],
-    radius:float):
-    _reset_output()
-
-    dataset = get_dataframe_from_address(
+    radius:float,
+    provider:str='OpenStreetMap',
+    dedupe_mode:str=DEDUPE_MODES[0]):
+    cache_miss('query')
+    cache_lookup('fetch')
+    dataset, init_origin = fetch_by_address(
         address=address,
         tags=tags,
-        radius=radius
-    )
-    location = from_address_to_lat_lon(address=address)
-    init_origin = Origin(lat=location.latitude, lon=location.longitude)
+        radius=radius,
+        provider=provider)
+    if not init_origin:
+        return {}, {}, {}, None, None, [], None
 
-    gdf_dict, city_info, \
-        avg_lat, avg_lon, objects = _elaborate_data(dataset=dataset,
+    gdf_dict, utm_dict, city_info, \
+        avg_lat, avg_lon, objects, columns = _dispatch(elaborate_data, 
+        dataset=dataset,
         tags=tags,
         origin=origin,
         clipping_radius=clipping_radius,
-        init_origin=init_origin)
-    return gdf_dict, city_info, avg_lat, avg_lon, objects
+        init_origin=init_origin,
+        dedupe_mode=dedupe_mode)
+    return gdf_dict, utm_dict, city_info, avg_lat, avg_lon, objects, \
+        columns
 
-@st.cache(suppress_st_warning=True)
+@st.cache(suppress_st_warning=True,
+    max_entries=QUERY_CACHE_ENTRIES, ttl=RESULT_TTL)
+@single_flight
 def run_query_by_zoom_building_only(origin:Origin,
     clipping_radius:int,
     address:str,
-    zoom:int):
-    _reset_output()
-
-    city_info, gdf_dict, utm_dict, \
-        avg_lat, avg_lon = osm_find_buildings(
+    zoom:int,
+    dedupe_mode:str=DEDUPE_MODES[0]):
+    cache_miss('query')
+    cache_lookup('fetch')
+    dataset, init_origin = fetch_by_zoom(
         address=address, 
-        zoom=zoom,
+        zoom=zoom)
+
+    return _dispatch(elaborate_buildings, 
+        dataset=dataset, 
+        init_origin=init_origin,
         origin=origin,
-        clipping_radius=clipping_radius)
-    
-    objects = []
-    for k, v in utm_dict.items():
-        color = _generate_legend_color_set(k)
-        objects.extend(get_geometry(v, color))
+        clipping_radius=clipping_radius,
+        dedupe_mode=dedupe_mode)
+
 
-    return gdf_dict, city_info, avg_lat, avg_lon, objects
+def _guard(estimate, value, fitted, name, unit=''):
+    '''Show the estimate of a query and apply the budgets.
+    It returns the value to run with or None to refuse.
+    '''
+    st.info(f'Estimate: {describe(estimate)}')
+    if fitted == value:
+        return value
 
+    exceeded = ', '.join(over_budget(estimate))
+    if fitted is None or BUDGET_POLICY == 'refuse':
+        st.error(f'The query exceeds the {exceeded} budget. ' + \
+            'Run it again on a smaller area.')
+        return None
+    st.warning(f'The query exceeds the {exceeded} budget, ' + \
+        f'the {name} is set to {fitted}{unit}.')
+    return fitted
+
+def _guard_radius(lat, lon, tags, radius):
+    clipping_radius = st.session_state.clipping_radius
+    estimate = estimate_by_radius(lat, lon, tags, radius, 
+        clipping_radius)
+    fitted = fit_radius(lat, lon, tags, radius, clipping_radius)
+    return _guard(estimate, radius, fitted, 'radius', ' m')
+
+def _record_radius(lat, lon, tags, radius, city_info):
+    '''Density of the result for the next estimates'''
+    estimate = estimate_by_radius(lat, lon, tags, radius,
+        st.session_state.clipping_radius)
+    record_density(lat, lon, list(tags), 
+        estimate['delivered_area'], city_info)
 
 def run_by_radius(lat, 
-    lon, tags, radius):
+    lon, tags, radius, provider='OpenStreetMap'):
+    radius = _guard_radius(lat, lon, tags, radius)
+    if not radius:
+        return
+    _reset_output()
     # set lat lon
     st.session_state.avg_lat = lat
     st.session_state.avg_lon = lon
 
-    gdf_dict, city_info, \
-        avg_lat, avg_lon, objects = run_query_by_radius(
+    cache_lookup('query')
+    gdf_dict, utm_dict, city_info, \
+        avg_lat, avg_lon, objects, columns = run_query_by_radius(
             st.session_state.origin,
             st.session_state.clipping_radius,
             lat=lat, lon=lon, 
-            tags=tags, radius=radius)
+            tags=tags, radius=radius,
+            provider=provider,
+            dedupe_mode=st.session_state.dedupe_mode)
     
     # update lat lon
     if avg_lat and avg_lon:
         st.session_state.avg_lat = avg_lat
         st.session_state.avg_lon = avg_lon
-    st.session_state.lbt_objects = objects
-    st.session_state.data = gdf_dict
-    st.session_state.labels = city_info
+    _save_output(gdf_dict, utm_dict, city_info, objects, columns)
+    _record_radius(lat, lon, tags, radius, city_info)
 
-def run_by_address(address, tags, radius):
-    # set lat lon
-    location = from_address_to_lat_lon(address=address)
+def run_by_address(address, tags, radius, provider='OpenStreetMap'):
+    location = geocode(address)
     if location:
-        st.session_state.avg_lat = location.latitude
-        st.session_state.avg_lon = location.longitude
-
-    gdf_dict, city_info, avg_lat, avg_lon, objects = run_query_by_address(
+        lat, lon = location.lat, location.lon
+        radius = _guard_radius(lat, lon, tags, radius)
+        if not radius:
+            return
+    _reset_output()
+    cache_lookup('query')
+    gdf_dict, utm_dict, city_info, \
+        avg_lat, avg_lon, objects, columns = run_query_by_address(
         st.session_state.origin,
         st.session_state.clipping_radius,
         address=address, 
         tags=tags, 
-        radius=radius)
+        radius=radius,
+        provider=provider,
+        dedupe_mode=st.session_state.dedupe_mode)
 
     # update lat lon
     if avg_lat and avg_lon:
         st.session_state.avg_lat = avg_lat
         st.session_state.avg_lon = avg_lon
-    st.session_state.lbt_objects = objects
-    st.session_state.data = gdf_dict
-    st.session_state.labels = city_info
+    _save_output(gdf_dict, utm_dict, city_info, objects, columns)
+    if location:
+        _record_radius(lat, lon, tags, radius, city_info)
 
 def run_by_zoom(address, zoom):
-    gdf_dict, city_info, \
-        avg_lat, avg_lon, objects = run_query_by_zoom_building_only(st.session_state.origin,
+    location = geocode(address)
+    if location:
+        lat, lon = location.lat, location.lon
+        clipping_radius = st.session_state.clipping_radius
+        estimate = estimate_by_zoom(lat, lon, zoom, clipping_radius)
+        fitted = fit_zoom(lat, lon, zoom, clipping_radius)
+        zoom = _guard(estimate, zoom, fitted, 'zoom')
+        if not zoom:
+            return
+    _reset_output()
+    cache_lookup('query')
+    gdf_dict, utm_dict, city_info, \
+        avg_lat, avg_lon, objects, columns = run_query_by_zoom_building_only(st.session_state.origin,
         st.session_state.clipping_radius,
-        address=address, zoom=zoom)
+        address=address, zoom=zoom,
+        dedupe_mode=st.session_state.dedupe_mode)
     
     # update output
     st.session_state.avg_lat = avg_lat
     st.session_state.avg_lon = avg_lon
-    st.session_state.lbt_objects = objects
-    st.session_state.data = gdf_dict
-    st.session_state.labels = city_info
-
-def _generate_legend_colors():
-    res = {}
-    for k in st.session_state.data.keys():
-        if k in st.session_state.colors_dict:
-            res[k] = st.session_state.colors_dict[k]
-    
-    return res
+    _save_output(gdf_dict, utm_dict, city_info, objects, columns)
+    if location:
+        estimate = estimate_by_zoom(lat, lon, zoom, clipping_radius)
+        record_density(lat, lon, ['buildings'], 
+            estimate['delivered_area'], city_info)
 
-def view_output(gdf_dict: dict, 
-    city_info: dict):
+def _generate_legend_colors(gdf_dict):
+    return {k: layer_color(k) for k in gdf_dict}
+
+class _SerializedDeck(pdk.Deck):
+    '''A deck that is serialized to JSON only once'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # None values are not serialized by pydeck
+        self._spec = None
+
+    def to_json(self):
+        if self._spec is None:
+            self._spec = super().to_json()
+        return self._spec
+
+def _generate_deck(gdf_dict: dict, 
+    avg_lat: float, 
+    avg_lon: float):
     lrs = [generate_osm_layers(k, v) for k, v in gdf_dict.items()]
+    INITIAL_VIEW_STATE = pdk.ViewState(
+        latitude=avg_lat,
+        longitude=avg_lon,
+        zoom=16,
+        max_zoom=18,
+        pitch=45,
+        bearing=0)
     
+    return _SerializedDeck(
+        map_style='mapbox://styles/mapbox/light-v9',
+        initial_view_state=INITIAL_VIEW_STATE,
+        layers=lrs)
+
+def _generate_model_json(geometry_dicts, reduce_faces, cull_walls):
+    model_dict, report = _dispatch(get_model, geometry_dicts, 
+        reduce_faces, cull_walls)
+    model_json = json.dumps(model_dict)
+    PAYLOAD_BYTES.labels('model').observe(len(model_json))
+    return model_json, report
+
+def set_model_options():
+    '''Shade optimisation of the model'''
+    msg = 'It removes the bottom faces of the buildings and ' + \
+        'merges coplanar walls. Use it for context shading.'
+    col1, col2 = st.columns(2)
+    reduce_faces = col1.checkbox('Context shades only',
+        key='reduce-faces',
+        help=msg)
+    msg = 'It removes or trims the walls shared by adjacent buildings.'
+    cull_walls = col2.checkbox('Cull shared walls',
+        key='cull-walls',
+        help=msg)
+    return reduce_faces, cull_walls
+
+def _shade_report(report):
+    removed = report['faces'] - report['shades']
+    msg = f'{report["shades"]} shades from {report["faces"]} faces ' + \
+        f'({removed} removed).'
+    if 'shared_walls' in report:
+        msg += f' {report["shared_walls"]} shared walls culled.'
+    return msg
+
+
+def view_output(gdf_dict: dict, 
+    city_info: dict,
+    objects: list):
     if st.session_state.avg_lat and \
         st.session_state.avg_lon and \
-        st.session_state.lbt_objects:
+        objects:
         st.markdown('---')
-        INITIAL_VIEW_STATE = pdk.ViewState(
-            latitude=st.session_state.avg_lat,
-            longitude=st.session_state.avg_lon,
-            zoom=16,
-            max_zoom=18,
-            pitch=45,
-            bearing=0)
-        
-        deck = pdk.Deck(
-            map_style='mapbox://styles/mapbox/light-v9',
-            initial_view_state=INITIAL_VIEW_STATE,
-            layers=lrs)
+        deck = _memo('deck', lambda: _generate_deck(gdf_dict,
+            st.session_state.avg_lat, st.session_state.avg_lon))
 
         # streamlit limit - it does not show hover info
         st.pydeck_chart(deck)
@@ -234,6 +478,138 @@ def view_output(gdf_dict: dict,
             unsafe_allow_html=True)
         st.json(city_info, expanded=False)
 
+def _observe_payload(name, data):
+    PAYLOAD_BYTES.labels(name).observe(len(data))
+    return data
+
+def _observe_json_payload(name, obj):
+    PAYLOAD_BYTES.labels(name).observe(len(json.dumps(obj)))
+
+def export_features(result):
+    '''Download features as GeoParquet or FlatGeobuf'''
+    status = st.checkbox('Export GIS data',
+        help='Features with height and tag columns.')
+    if not status:
+        return
+
+    col1, col2 = st.columns(2)
+    fmt = col1.selectbox('Format', 
+        options=tuple(EXPORTERS.keys()),
+        key='export-format')
+    frame = col2.selectbox('Coordinates', 
+        options=FRAMES,
+        key='export-frame',
+        help='Local coordinates are in meters from the origin.')
+    
+    writer, ext = EXPORTERS[fmt]
+    name = f'export-{fmt}-{frame}'
+    data = _memo(name, lambda: _observe_payload(
+        'export', writer(result['columns'], frame == 'Local')))
+    _download(data, name, 
+        file_name=f'context.{ext}',
+        mime='application/octet-stream',
+        key='export-download')
+
+def _download(data, name, file_name, mime, key):
+    '''Download button, gzip compressed if selected'''
+    if st.checkbox('Gzip', key=f'{key}-gzip',
+        help='Compress the file before the download.'):
+        data = _memo(f'{name}-gzip', lambda: compress(data))
+        file_name += '.gz'
+        mime = 'application/gzip'
+    st.download_button('Download', 
+        data=data,
+        file_name=file_name,
+        mime=mime,
+        key=key)
+
+def _toggle_progress():
+    progress = st.session_state.cad_progress
+    progress['stopped'] = not progress['stopped']
+
+def _identifiers(batch):
+    return {g.get('identifier') or get_identifier(g) for g in batch}
+
+def send_changes(objects, progressive=False):
+    '''Send to the CAD host only the geometry that changed.
+    The preview goes in batches of up to CHUNK_BYTES, rings around
+    the origin keyed by the identifiers of their objects. The host
+    keeps the batches it already has, the ones that are not sent
+    anymore are removed and only the new ones are added. With
+    progressive the new batches are added nearest first, CHUNK_BYTES
+    at each run.
+    It returns True if there are more batches to send.
+    '''
+    batches = _memo('cad-batches', lambda: get_batches(objects,
+        CHUNK_BYTES))
+    result_key = st.session_state.result_key
+    sent = st.session_state.cad_sent
+    progress = st.session_state.cad_progress
+    if progress.get('key') != result_key:
+        progress.update(key=result_key, stopped=False)
+
+    shown, pending, spent = [], 0, 0
+    for key, batch, nbytes in batches:
+        if progressive and key not in sent:
+            # nearest first: once a batch waits the farther ones wait
+            if progress['stopped'] or pending or \
+                (spent and spent + nbytes > CHUNK_BYTES):
+                pending += 1
+                continue
+            spent += nbytes
+        shown.append((key, batch, nbytes))
+
+    for key, batch, _ in shown:
+        send_geometry(key=f'geo-{key}', 
+            geometry=batch,
+            option='subscribe-preview',
+            options={'add':False, 
+            'delete':False, 
+            'preview':False,
+            'clear':False})
+
+    added = [b for b in shown if b[0] not in sent]
+    if added:
+        PAYLOAD_BYTES.labels('cad').observe(sum(b[2] for b in added))
+    ids = set().union(*(_identifiers(b) for _, b, _ in shown))
+    old_ids = set().union(*sent.values())
+    st.session_state.cad_sent = {k: _identifiers(b) for k, b, _ in shown}
+    st.caption(f'{len(ids - old_ids)} objects added, '
+        f'{len(old_ids - ids)} removed, '
+        f'{len(ids & old_ids)} unchanged.')
+
+    if not progressive:
+        return False
+    loaded = sum(len(b) for _, b, _ in shown)
+    st.progress(loaded / max(len(objects), 1))
+    st.caption(f'{loaded} of {len(objects)} '
+        f'objects loaded, nearest first.')
+    if pending:
+        label = 'Resume loading' if progress['stopped'] \
+            else 'Stop loading'
+        st.button(label, key='cad-progress', on_click=_toggle_progress)
+        return not progress['stopped']
+    
+    return False
+
+def send_bake(objects):
+    '''Add the whole context to the CAD document or delete it.
+    It sends every object, so it is drawn only when asked.
+    '''
+    if not st.checkbox('Bake to document', key='cad-bake',
+        help='Add or delete the whole context in the CAD document.'):
+        return
+    send_geometry(key='geo-bake', 
+        geometry=objects,
+        option='add',
+        options={'subscribe-preview':False, 
+        'delete':True, 
+        'preview':False,
+        'clear':True})
+
+def _send_next_batches():
+    st.experimental_rerun()
+
 def set_cad_settings():
     if st.session_state.platform != 'web':
         loc = Location(latitude=st.session_state.avg_lat,
@@ -241,41 +617,58 @@ def set_cad_settings():
         manage_settings(key='cad-settings', settings={'location':loc.to_dict()})
 
 def get_output():
+    result = get_result()
+    if result is None:
+        return
+    objects = result['lbt_objects']
     col1, col2 = st.columns([1, 3])
     if st.session_state.platform == 'web':
         with col1:
-            generate_legend(_generate_legend_colors())
+            generate_legend(_generate_legend_colors(result['data']))
         with col2:
             msg = 'Only shades surfaces are supported. Use it for buildings.'
-            view_output(st.session_state.data, 
-            st.session_state.labels)
+            view_output(result['data'], 
+            result['labels'], objects)
             status = st.checkbox('Generate Pollination Model',
                 help=msg)
             if status:
-                model_dict = get_model(st.session_state.lbt_objects)
-                st.download_button('Download', 
-                    data=json.dumps(model_dict),
+                model_options = set_model_options()
+                name = f'model-json-{model_options}'
+                model_json, report = _memo(name, 
+                    lambda: _generate_model_json(
+                        objects, *model_options))
+                st.caption(_shade_report(report))
+                _download(model_json, name,
                     file_name='model.hbjson',
-                    mime='text/json')
+                    mime='text/json',
+                    key='model-download')
+            export_features(result)
     else:
         set_cad_settings()
         with col1:
-            generate_legend(_generate_legend_colors())
+            generate_legend(_generate_legend_colors(result['data']))
         with col2:
-            # TODO: fix small bug tab content <> custom button
-            send_geometry(key='geo-preview', 
-                geometry=st.session_state.lbt_objects,
-                option='subscribe-preview',
-                options={'add':True, 
-                'delete':True, 
-                'preview':False,
-                'clear':True})
+            progressive = st.checkbox('Progressive loading',
+                key='progressive',
+                help='Send the new geometry in small chunks, nearest first.')
+            has_next = send_changes(objects, progressive)
+            # after the progressive loading, not at each of its steps
+            if not has_next:
+                send_bake(objects)
             status = st.checkbox('Convert to Pollination Model')
             if status:
-                model_dict = get_model(st.session_state.lbt_objects)
+                model_options = set_model_options()
+                model_dict, report = _memo(f'model-{model_options}', 
+                    lambda: _dispatch(get_model, objects, 
+                        *model_options))
+                _memo(f'model-payload-{model_options}', 
+                    lambda: _observe_json_payload('model', model_dict))
+                st.caption(_shade_report(report))
                 send_hbjson(key='model-shades', hbjson=model_dict, 
                     option='add',
                     options={'subscribe-preview':False,
                     'preview':False,
                     'clear':False})
-    
+        # after the page is drawn
+        if has_next:
+            _send_next_batches()
@@ -0,0 +1,106 @@
+# coding=utf-8
+''' A module to share in-flight computations across sessions.
+
+Streamlit runs each session on its own thread of the same process.
+Concurrent calls with the same normalized arguments wait for the
+first one instead of running the same query again.
+'''
+import inspect
+import threading
+from functools import wraps
+
+# decimals of coordinates, about 10 cm
+COORDINATE_DIGITS = 6
+# free text arguments compared without case and extra whitespace,
+# the others are case-sensitive like OSM tags
+FOLDED_ARGUMENTS = ('address',)
+
+class _Call:
+
+    __slots__ = (
+      'event', 'result', 'error'
+    )
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    ''' Run a function once for concurrent calls with the same key '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+def fold(text: str) -> str:
+    ''' Text without case and extra whitespace '''
+    return ' '.join(text.split()).casefold()
+
+def normalize(value):
+    ''' Hashable form of an argument, equal for equivalent requests '''
+    if value is None or isinstance(value, (bool, int)):
+        return value
+    if isinstance(value, float):
+        return round(value, COORDINATE_DIGITS)
+    if isinstance(value, dict):
+        return tuple(sorted((normalize(k), normalize(v))
+            for k, v in value.items()))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [normalize(v) for v in value]
+        try:
+            return tuple(sorted(items))
+        except TypeError:
+            return tuple(items)
+    slots = getattr(type(value), '__slots__', None)
+    if slots:
+        return (type(value).__name__,) + tuple(
+            normalize(getattr(value, s, None)) for s in slots)
+    if hasattr(value, '__dict__'):
+        return (type(value).__name__, normalize(vars(value)))
+    return value
+
+_flight = SingleFlight()
+
+def single_flight(fn):
+    ''' Decorator to coalesce concurrent identical calls of a function '''
+    signature = inspect.signature(fn)
+    name = f'{fn.__module__}.{fn.__qualname__}'
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = dict(bound.arguments)
+        for arg in FOLDED_ARGUMENTS:
+            if isinstance(arguments.get(arg), str):
+                arguments[arg] = fold(arguments[arg])
+        key = (name, normalize(arguments))
+        return _flight.do(key, fn, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,139 @@
+# coding=utf-8
+''' A module to share query results across sessions.
+
+Results are kept once per process, compressed and addressed by the
+hash of their content. Sessions only hold the key. Results that are
+not read for CONTEXT3D_RESULT_TTL seconds are evicted, and the least
+recently read ones go first when the store is over its size.
+'''
+import os
+import json
+import time
+import zlib
+import threading
+from typing import Callable, Optional
+from collections import OrderedDict
+from metrics import RESULT_STORE_BYTES
+from serialize import dumps
+
+RESULT_TTL = int(os.environ.get('CONTEXT3D_RESULT_TTL', 1800))
+MAX_STORE_BYTES = int(os.environ.get('CONTEXT3D_STORE_BYTES', 500000000))
+# decompressed results kept for the sessions reading them now
+HOT_RESULTS = 4
+COMPRESSION_LEVEL = 6
+
+class _Entry:
+
+    __slots__ = (
+      'parts', 'raw', 'nbytes', 'last_read', 'artifacts'
+    )
+
+    def __init__(self, parts: dict, raw: set):
+        self.parts = parts
+        # parts stored as bytes, not JSON
+        self.raw = raw
+        self.nbytes = sum(len(v) for v in parts.values())
+        self.last_read = time.monotonic()
+        self.artifacts = {}
+
+class ResultStore:
+    ''' Compressed results shared by all sessions '''
+
+    def __init__(self, ttl: int = RESULT_TTL,
+        max_bytes: int = MAX_STORE_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._hot = OrderedDict()
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            return sum(e.nbytes for e in self._entries.values())
+
+    def put(self, key: str, result: dict) -> str:
+        ''' Store a result of JSON values once '''
+        with self._lock:
+            if key in self._entries:
+                self._touch(key)
+                return key
+        parts = {k: zlib.compress(v if isinstance(v, bytes) 
+            else dumps(v).encode(), COMPRESSION_LEVEL)
+            for k, v in result.items()}
+        raw = {k for k, v in result.items() if isinstance(v, bytes)}
+        with self._lock:
+            self._entries[key] = _Entry(parts, raw)
+            self._hot[key] = result
+            self._touch(key)
+            self._evict()
+        return key
+
+    def get(self, key: Optional[str]) -> Optional[dict]:
+        ''' The result of a key, None if it was evicted '''
+        if key is None:
+            return None
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._touch(key)
+            result = self._hot.get(key)
+            if result is not None:
+                return result
+            parts, raw = entry.parts, entry.raw
+
+        result = {k: zlib.decompress(v) if k in raw
+            else json.loads(zlib.decompress(v))
+            for k, v in parts.items()}
+        with self._lock:
+            if key in self._entries:
+                self._hot[key] = result
+                self._touch(key)
+        return result
+
+    def __contains__(self, key: Optional[str]) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def artifact(self, key: str, name: str, fn: Callable):
+        ''' Build an artifact of a result once for all sessions.
+        It is evicted with the result.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and name in entry.artifacts:
+                return entry.artifacts[name]
+
+        value = fn()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value = entry.artifacts.setdefault(name, value)
+                if isinstance(value, (bytes, str)):
+                    entry.nbytes += len(value)
+        return value
+
+    def _touch(self, key: str):
+        self._entries[key].last_read = time.monotonic()
+        self._entries.move_to_end(key)
+        if key in self._hot:
+            self._hot.move_to_end(key)
+            while len(self._hot) > HOT_RESULTS:
+                self._hot.popitem(last=False)
+
+    def _evict(self):
+        ''' Drop idle results and the least read ones over the size '''
+        now = time.monotonic()
+        total = sum(e.nbytes for e in self._entries.values())
+        for key in list(self._entries):
+            entry = self._entries[key]
+            if now - entry.last_read > self.ttl or \
+                (total > self.max_bytes and len(self._entries) > 1):
+                total -= entry.nbytes
+                del self._entries[key]
+                self._hot.pop(key, None)
+
+RESULTS = ResultStore()
+RESULT_STORE_BYTES.set_function(lambda: RESULTS.nbytes)